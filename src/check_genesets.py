@@ -1,92 +1,180 @@
-#!/usr/bin/env zsh
+#!/usr/bin/env python3
+"""Compare two genesets.json files made by `make_genesets.py`
 
-from pathlib import Path
-import json
-from bonsai.bonsai import Tree
-from dataclasses import dataclass
-
-def id_to_name(node_id: str, tree: Tree):
-    node = tree.nodes[node_id]
-
-    return node.name
-
-@dataclass
-class HashDiff:
-    path_original: str
-    path_hash: str
-    content_original: str
-    content_hash: str
-    unique_original: str
-    unique_hash: str
-
-    id: str
-
-def hash_node(node_id: str, tree: Tree) -> HashDiff:
-    path = tree.get_path_of(node_id)
-    path = [id_to_name(x, tree) for x in path]
-    path = "/".join(path)
-
-    contents = tree.nodes[node_id].data
-    contents.sort()
-
-    blob = f"{path}{'-'.join(contents)}"
-
-    print(f"{blob}")
-
-    return HashDiff(
-        path_original=path,
-        path_hash=hash(path),
-        content_original='-'.join(contents),
-        content_hash=hash(contents),
-        unique_hash=hash(blob),
-        unique_original=blob,
-        id=node_id
-    )
-
-def check_diff(one: HashDiff, two: HashDiff):
-    if one.unique_hash == two.unique_hash:
-        return
-
-    if one.content_hash != two.content_hash:
-        print(f"Content {one.content_original} differes from {two.content_original}")
+Each node gets a Merkle hash, computed bottom-up from its name, its (sorted)
+genes and the hashes of its children. Two trees are then compared from the
+root, only descending in the subtrees whose hashes differ, so identical
+trees are compared in linear time and different ones only cost as much as
+their differences.
 
-    if one.path_hash != two.path_hash:
-        print(f"Path {one.path_original} differs from {two.path_hash}")
+Node IDs are ignored: nodes are matched by their name among their siblings.
+"""
 
-def main(args):
-
-    with args.one.open("r") as one_conn, args.two.open("r") as two_conn:
-        one = json.load(one_conn)
-        one = Tree.from_node_json(one)
-        two = json.load(two_conn)
-        two = Tree.from_node_json(two)
-
-    print(f"Loaded bonsai: one: {one} , two: {two}")
+from __future__ import annotations
 
-    print("Compute hashes")
-    one_hashes = {}
-    two_hashes = {}
+import json
+import sys
+from dataclasses import dataclass, field
+from hashlib import sha256
+from pathlib import Path
 
-    for node in one.nodes.values():
-        t = hash_node(node.id, one)
-        one_hashes[t.unique_hash] = t
+PATH_SEP = "/"
 
-    for node in two.nodes.values():
-        two_hashes[hash_node(node.id, two)] = node.id
 
-    print("Checking for differences...")
+@dataclass
+class MerkleNode:
+    name: str
+    genes: frozenset[str]
+    path: str
+    children: dict[str, MerkleNode] = field(default_factory=dict)
+    # Hash of the name and genes of just this node
+    content_hash: str = ""
+    # Hash of the content and of all the children of this node
+    tree_hash: str = ""
 
-    all_hashes = []
-    ids = set()
-    for x in (list(one_hashes.values()) + list(two_hashes.values())):
-        if x.unique_hash not in ids:
-            all_hashes.append(x)
-            ids.add(x.unique_hash)
 
-    one_ids = [x.unique_hash for x in one_hashes.values()]
-    two_ids = [x.unique_hash for x in two_hashes.values()]
+@dataclass
+class DiffReport:
+    # Paths of subtrees that are only in the second tree
+    added: list[str] = field(default_factory=list)
+    # Paths of subtrees that are only in the first tree
+    removed: list[str] = field(default_factory=list)
+    # Nodes in both trees with different genes
+    changed: list[dict] = field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not (self.added or self.removed or self.changed)
+
+    def to_dict(self) -> dict:
+        return {"added": self.added, "removed": self.removed, "changed": self.changed}
+
+
+def build_merkle_tree(nodes: dict) -> MerkleNode:
+    """Build the Merkle tree of a node JSON, as loaded from genesets.json"""
+    children_of: dict[str, list[str]] = {}
+    roots = []
+    for node_id, node in nodes.items():
+        if node["parent"] is None:
+            roots.append(node_id)
+        else:
+            children_of.setdefault(node["parent"], []).append(node_id)
+
+    if len(roots) != 1:
+        raise ValueError(f"Expected one root node, found {len(roots)}")
+
+    # Visit the tree top-down to set up the paths, and remember the order,
+    # so that we can then compute the hashes bottom-up without recursion.
+    merkle: dict[str, MerkleNode] = {}
+    order = []
+    stack = [(roots[0], None)]
+    while stack:
+        node_id, parent = stack.pop()
+        node = nodes[node_id]
+        name = node["name"]
+        if parent is not None:
+            # Siblings should have unique names, but just in case they do not
+            # make them unique so that no node is lost.
+            key, i = name, 1
+            while key in parent.children:
+                i += 1
+                key = f"{name}#{i}"
+            path = parent.path + PATH_SEP + key
+        else:
+            key, path = name, name
+        current = MerkleNode(name=name, genes=frozenset(node["data"] or []), path=path)
+        if parent is not None:
+            parent.children[key] = current
+        merkle[node_id] = current
+        order.append(node_id)
+        stack.extend((x, current) for x in children_of.get(node_id, []))
+
+    for node_id in reversed(order):
+        current = merkle[node_id]
+        content = sha256(current.name.encode("utf-8"))
+        content.update(b"\0")
+        content.update("\0".join(sorted(current.genes)).encode("utf-8"))
+        current.content_hash = content.hexdigest()
+
+        full = sha256(current.content_hash.encode("utf-8"))
+        for key in sorted(current.children):
+            full.update(b"\0")
+            full.update(key.encode("utf-8"))
+            full.update(current.children[key].tree_hash.encode("utf-8"))
+        current.tree_hash = full.hexdigest()
+
+    return merkle[roots[0]]
+
+
+def diff_trees(one: MerkleNode, two: MerkleNode) -> DiffReport:
+    """Compare two Merkle trees, descending only in subtrees that differ"""
+    report = DiffReport()
+
+    if one.name != two.name:
+        report.removed.append(one.path)
+        report.added.append(two.path)
+        return report
+
+    stack = [(one, two)]
+    while stack:
+        first, second = stack.pop()
+        if first.tree_hash == second.tree_hash:
+            continue
+
+        if first.content_hash != second.content_hash:
+            report.changed.append(
+                {
+                    "path": first.path,
+                    "genes_added": sorted(second.genes - first.genes),
+                    "genes_removed": sorted(first.genes - second.genes),
+                }
+            )
+
+        for key, child in first.children.items():
+            if key not in second.children:
+                report.removed.append(child.path)
+            else:
+                stack.append((child, second.children[key]))
+        for key, child in second.children.items():
+            if key not in first.children:
+                report.added.append(child.path)
+
+    report.added.sort()
+    report.removed.sort()
+    report.changed.sort(key=lambda x: x["path"])
+
+    return report
+
+
+def load_merkle_tree(path: Path) -> MerkleNode:
+    with path.open("r") as stream:
+        return build_merkle_tree(json.load(stream))
 
 
+def main(args):
+    one = load_merkle_tree(args.one)
+    two = load_merkle_tree(args.two)
+
+    report = diff_trees(one, two)
+
+    if args.json:
+        json.dump(report.to_dict(), sys.stdout, indent=2)
+        print()
+    elif report.is_empty():
+        print("The two trees are identical.")
+    else:
+        for path in report.removed:
+            print(f"- {path}")
+        for path in report.added:
+            print(f"+ {path}")
+        for item in report.changed:
+            print(
+                f"~ {item['path']} (+{len(item['genes_added'])} -{len(item['genes_removed'])} genes)"
+            )
+        print(
+            f"{len(report.removed)} removed, {len(report.added)} added, {len(report.changed)} changed."
+        )
+
+    sys.exit(0 if report.is_empty() else 1)
 
 
 if __name__ == "__main__":
@@ -96,6 +184,9 @@ if __name__ == "__main__":
 
     parser.add_argument("one", type=Path, help="First JSON to parse")
     parser.add_argument("two", type=Path, help="Second JSON to parse")
+    parser.add_argument(
+        "--json", help="Print the differences as a JSON report", action="store_true"
+    )
 
     args = parser.parse_args()
 
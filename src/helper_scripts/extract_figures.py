@@ -2,46 +2,55 @@
 
 import os
 import re
+import shutil
 import tarfile
-import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from shutil import copy
 
 
-def main(path: Path, temp_dir: Path):
+def main(path: Path, jobs: int = 4):
     """Point this to the tranportome_profiler_results.tar file to get images
 
     It creates the 'images' folder with the correct file names to be used
     in the tranportome profiler paper.
+
+    Nothing is extracted but the images: the inner archives are streamed
+    straight out of the outer one (many at once), and only the members in
+    `TARGETS` (or `EXTRA_PLOT_TARGETS`) are written to their destinations.
     """
+    output_dir = Path(path).parent
 
-    # Extract the tar archive to the temp dir
+    # Find the inner tar archives
+    result_regex = re.compile(r"packaged_output_(.*?).tar.gz")
     with tarfile.open(path) as tar:
-        tar.extractall(temp_dir, filter="data")
+        names = tar.getnames()
 
-    # Extract all inner tar archives
-    result_regex = re.compile(r"packaged_output_(.*?).tar.gz")
-    results = {}
-    for file in temp_dir.iterdir():
-        match = result_regex.match(file.name)
+    jobs_args = []
+    for name in names:
+        match = result_regex.match(Path(name).name)
         if not match:
             continue
         result_name = match.group(1)
-        print(f"Looking into {file} ({result_name})")
-        results[result_name] = file
-
-    for name, tar_path in results.items():
-        extract_images(output_dir=Path(path).parent, target=tar_path, slug=name)
-
-    ## We're done - extract the extra plots
-    extra_plots = Path(temp_dir) / "extra_plots.tar.gz"
-    tar = tarfile.open(extra_plots, mode="r:gz")
-    with tempfile.TemporaryDirectory() as tmp:
-        tar.extractall(tmp, filter="data")
-        for target, dist in EXTRA_PLOT_TARGETS.items():
-            full_dist = Path(path).parent / dist
-            os.makedirs(full_dist.parent, exist_ok=True)
-            copy(Path(tmp) / target, full_dist)
+        print(f"Looking into {name} ({result_name})")
+        targets = {
+            source: output_dir / dest.format(slug=result_name)
+            for source, dest in TARGETS.items()
+        }
+        jobs_args.append((name, targets))
+
+    ## Also extract the extra plots
+    extra_plots = next(x for x in names if Path(x).name == "extra_plots.tar.gz")
+    jobs_args.append(
+        (extra_plots, {k: output_dir / v for k, v in EXTRA_PLOT_TARGETS.items()})
+    )
+
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = [
+            pool.submit(extract_images, path, name, targets)
+            for name, targets in jobs_args
+        ]
+        for future in futures:
+            future.result()
 
 
 TARGETS = {
@@ -74,14 +83,30 @@ EXTRA_PLOT_TARGETS = {
 }
 
 
-def extract_images(output_dir: Path, target: Path, slug: str):
-    with tempfile.TemporaryDirectory() as tmp:
-        tar = tarfile.open(target, mode="r:gz")
-        tar.extractall(tmp, filter="data")
-        for source, dest in TARGETS.items():
-            full_target = output_dir / dest.format(slug=slug)
-            os.makedirs(full_target.parent, exist_ok=True)
-            copy(Path(tmp) / source, full_target)
+def extract_images(path: Path, inner: str, targets: dict[str, Path]):
+    """Copy some members of an inner archive of `path` to their destinations
+
+    The inner archive is decompressed as it is read, and reading stops as
+    soon as all the targets are found.
+    """
+    missing = dict(targets)
+    # Each job opens the outer archive on its own, so they can run in parallel
+    with tarfile.open(path) as outer:
+        stream = outer.extractfile(inner)
+        with tarfile.open(fileobj=stream, mode="r|gz") as tar:
+            for member in tar:
+                name = member.name[2:] if member.name.startswith("./") else member.name
+                if name not in missing or not member.isfile():
+                    continue
+                dest = missing.pop(name)
+                os.makedirs(dest.parent, exist_ok=True)
+                with open(dest, "wb") as out:
+                    shutil.copyfileobj(tar.extractfile(member), out)
+                if not missing:
+                    break
+
+    if missing:
+        raise FileNotFoundError(f"Could not find {', '.join(missing)} in {inner}")
 
 
 if __name__ == "__main__":
@@ -89,8 +114,8 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("path", help="Path to the output tar archive")
+    parser.add_argument("--jobs", type=int, default=4, help="Number of inner archives to read at once")
 
     args = parser.parse_args()
 
-    with tempfile.TemporaryDirectory() as dir:
-        main(args.path, Path(dir))
+    main(args.path, args.jobs)
@@ -1,12 +1,15 @@
 import functools as ft
+import importlib.util
 import json
 import logging
-import subprocess
-import tempfile
-import uuid
+import multiprocessing as mp
+import os
+import queue
+import sys
+import traceback
 from hashlib import sha256
+from pathlib import Path
 
-import bonsai
 from tqdm import tqdm
 
 log = logging.getLogger(__name__)
@@ -21,166 +24,250 @@ class IncongruencyError(Exception):
         return f"Inconsistency error at {self.location}: {self.inconsistency}"
 
 
-def launch_ariadne(exec, args, target_file):
-    log.debug(f"Running Ariadne to create {target_file}")
-    all_args = [exec]
-    all_args.extend(args)
-    all_args.extend([target_file, "/dev/null"])
-    ret = subprocess.run(all_args, capture_output=True)
-    if ret.returncode != 0:
-        raise RuntimeError(
-            f"Ariadne failed to run:\n{ret.stderr.decode("UTF-8")}",
-        )
-
-    with open(target_file, "r") as f:
-        return json.load(f)
-
-
-def which(iterable):
-    enum = [i for i, x in enumerate(iterable) if x]
-    if len(enum) == 1:
-        return enum[0]
-    return enum
-
-
-def find(items, fn):
-    """Find one and only one item in a list
-
-    The fn is a function that takes each item and returns True or False.
-    """
-    checks = [fn(x) for x in items]
-    if sum(checks) == 1:
-        return items[which(checks)]
-    elif sum(checks) > 1:
-        raise RuntimeError("Found more than one matching item")
-    else:
-        raise RuntimeError("Item not found")
-
-
-def get_children_named(tree: bonsai.Tree, parent_id, name):
-    childrens = tree.get_direct_children(parent_id)
-    return find(childrens, lambda x: x.name == name)
+def load_ariadne(path: Path):
+    """Import the geneset builder (make_genesets.py) from its path"""
+    path = Path(path).absolute()
+    # Ariadne imports its sibling modules
+    sys.path.insert(0, str(path.parent))
+    spec = importlib.util.spec_from_file_location("make_genesets", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
 
 def check_two_way_congruency(list_1, list_2):
-    # Could probably forgo one check and check for len but whatever
-    if not all([x in list_2 for x in list_1]):
+    set_1 = set(list_1)
+    set_2 = set(list_2)
+    if not set_1 <= set_2:
         raise RuntimeError(
             f"Did not find some items in list 1 inside list 2. Length of one: {len(list_1)} vs two {len(list_2)}"
         )
-    if not all([x in list_1 for x in list_2]):
+    if not set_2 <= set_1:
         raise RuntimeError(
             f"Did not find some items in list 2 inside list 1. Length of one: {len(list_1)} vs two {len(list_2)}"
         )
     return True
 
 
-def get_location_of(tree: bonsai.Tree, node_id):
-    path = tree.get_path_of(node_id)
-    names = [tree.nodes[x].name for x in path]
-    spath = ""
-    for name in names:
-        spath += name + "///"
+class IndexedNodes:
+    """A node JSON with its children indexed by name"""
+
+    def __init__(self, nodes: dict):
+        self.nodes = nodes
+        self.children: dict[str, dict[str, str]] = {x: {} for x in nodes}
+        roots = []
+        for node_id, node in nodes.items():
+            if node["parent"] is None:
+                roots.append(node_id)
+                continue
+            siblings = self.children[node["parent"]]
+            if node["name"] in siblings:
+                raise RuntimeError(
+                    f"Found more than one node named {node['name']} at {self.location_of(node['parent'])}"
+                )
+            siblings[node["name"]] = node_id
+
+        if len(roots) != 1:
+            raise RuntimeError(f"Expected one root, found {len(roots)}")
+        self.root = roots[0]
+
+    def location_of(self, node_id):
+        names = []
+        while node_id is not None:
+            names.append(self.nodes[node_id]["name"])
+            node_id = self.nodes[node_id]["parent"]
 
-    return spath.strip("/")
+        return "///".join(reversed(names))
 
 
-def test_congruency(one: bonsai.Tree, two: bonsai.Tree):
-    def compare_childrens(parent_one_id, parent_two_id):
-        first_children = one.get_direct_children(parent_one_id)
-        second_children = two.get_direct_children(parent_two_id)
-        first_children_names = [one.nodes[x.id].name for x in first_children]
-        second_children_names = [two.nodes[x.id].name for x in second_children]
+def test_congruency(one: IndexedNodes, two: IndexedNodes):
+    stack = [(one.root, two.root)]
+    while stack:
+        parent_one_id, parent_two_id = stack.pop()
+        first_children = one.children[parent_one_id]
+        second_children = two.children[parent_two_id]
 
         log.debug(
-            f"Comparing {one.nodes[parent_one_id].name} with {two.nodes[parent_two_id].name}"
+            f"Comparing {one.nodes[parent_one_id]['name']} with {two.nodes[parent_two_id]['name']}"
         )
 
         if not first_children and not second_children:
             # There are no nodes to compare - the two parents are leaves.
-            # This is the safe exit condition of the recursion.
-            log.debug("Nodes are leaves. Returning.")
-            return
+            continue
         elif not first_children:
             # There are second children but not first ones. Panic!
             raise IncongruencyError(
-                get_location_of(one, parent_one_id),
-                f"This node in the first tree should have children: {second_children_names}",
+                one.location_of(parent_one_id),
+                f"This node in the first tree should have children: {list(second_children)}",
             )
         elif not second_children:
             # Same, but reversed
             raise IncongruencyError(
-                get_location_of(two, parent_two_id),
-                f"This node in the second tree should have children: {first_children_names}",
+                two.location_of(parent_two_id),
+                f"This node in the second tree should have children: {list(first_children)}",
             )
 
         if not len(first_children) == len(second_children):
             raise IncongruencyError(
-                f"{one.nodes[parent_one_id].name} and {two.nodes[parent_two_id].name}",
-                f"Different number of children, {len(first_children)} vs {len(second_children)}: {first_children_names} vs {second_children_names}",
+                f"{one.nodes[parent_one_id]['name']} and {two.nodes[parent_two_id]['name']}",
+                f"Different number of children, {len(first_children)} vs {len(second_children)}: {list(first_children)} vs {list(second_children)}",
             )
 
-        # It does not matter which of the two lists we check - they have the same length.
-        for child in first_children:
-            try:
-                sibling = find(second_children, lambda x: x.name == child.name)
-            except RuntimeError as e:
+        # It does not matter which of the two we check - they have the same length.
+        for name, child_id in first_children.items():
+            sibling_id = second_children.get(name, None)
+            if sibling_id is None:
                 raise IncongruencyError(
-                    f"{get_location_of(one, child.id)}",
-                    f"could not locate sibling node: {str(e)}",
+                    one.location_of(child_id), "could not locate sibling node"
                 )
 
             try:
-                check_two_way_congruency(child.data, sibling.data)
+                check_two_way_congruency(
+                    one.nodes[child_id]["data"] or [], two.nodes[sibling_id]["data"] or []
+                )
             except RuntimeError as e:
-                raise IncongruencyError(f"{get_location_of(one, child.id)}", str(e))
+                raise IncongruencyError(one.location_of(child_id), str(e))
+
+            # These children are identical: check in turn their children.
+            stack.append((child_id, sibling_id))
 
-            # We are done comparing these children: they are identical.
-            # now, check in turn their children.
-            log.debug("Moving down...")
-            compare_childrens(child.id, sibling.id)
 
-    # Get the roots of the trees and start checking
-    compare_childrens(one.root.id, two.root.id)
+## The state of each worker, set by `init_worker`
+ariadne = None
+ariadne_args = None
+
+
+def init_worker(exec_path, args):
+    global ariadne, ariadne_args
+    ariadne = load_ariadne(exec_path)
+    # The bars of the workers would just clobber each other
+    ariadne.tqdm = ft.partial(tqdm, disable=True)
+    ariadne.log.setLevel(logging.WARNING)
+    ariadne_args = args
+
+
+def run_ariadne():
+    # Reset the module-level state, so this runs like a brand new process would
+    ariadne.builder = ariadne.IdBuilder()
+    ariadne.random.seed(ariadne.SEED)
+    ariadne.numpy.random.seed(ariadne.SEED)
+    node_json, _ = ariadne.make_genesets(ariadne_args)
+    return node_json
+
+
+def run_worker(hash_seed, exec_path, args, results):
+    """Run Ariadne once, and send back the node JSON (or the error)"""
+    try:
+        init_worker(exec_path, args)
+        results.put((hash_seed, True, run_ariadne()))
+    # Even on `sys.exit`, so that only workers that crash send nothing
+    except BaseException:
+        results.put((hash_seed, False, traceback.format_exc()))
+
+
+def start_worker(context, hash_seed, exec_path, args, results, running):
+    """Run Ariadne in a new interpreter, with some hash seed
+
+    Trees that depend on the iteration order of sets and dicts are exactly
+    what we are looking for, so each run needs its own hash seed. This can
+    only be set before the interpreter starts, so the context must "spawn"
+    the workers, one at a time.
+
+    The process is added to `running`, keyed by its seed.
+    """
+    # Spawned processes get the environment as it is when they start
+    previous = os.environ.get("PYTHONHASHSEED")
+    os.environ["PYTHONHASHSEED"] = str(hash_seed)
+    try:
+        process = context.Process(
+            target=run_worker, args=(hash_seed, exec_path, args, results), daemon=True
+        )
+        process.start()
+        running[hash_seed] = process
+    finally:
+        if previous is None:
+            del os.environ["PYTHONHASHSEED"]
+        else:
+            os.environ["PYTHONHASHSEED"] = previous
+
+
+def get_result(results, running):
+    """Wait for the result of any of the `running` workers
+
+    Workers that die without sending one (e.g. killed for lack of memory)
+    are reported as failures, instead of being waited for forever.
+    """
+    while True:
+        try:
+            hash_seed, ok, response = results.get(timeout=1)
+        except queue.Empty:
+            for hash_seed, process in running.items():
+                if process.exitcode not in (None, 0):
+                    raise RuntimeError(
+                        f"Ariadne (hash seed {hash_seed}) died with exit code {process.exitcode}"
+                    )
+            continue
+
+        running.pop(hash_seed).join()
+        if not ok:
+            raise RuntimeError(f"Ariadne (hash seed {hash_seed}) failed to run:\n{response}")
+        return response
 
 
 def main(args, extra):
-    ariadne = ft.partial(launch_ariadne, exec=args.exec, args=extra)
+    ariadne_module = load_ariadne(args.exec)
+    # The output paths are required but never written to
+    ariadne_args = ariadne_module.make_parser().parse_args(
+        extra + ["/dev/null", "/dev/null"]
+    )
+    # Each trial must build the tree from scratch, or we are testing the cache
+    ariadne_args.cache_dir = None
+
+    context = mp.get_context("spawn")
+    results = context.Queue()
+    running = {}
+
+    # The template is made with hash seed 0 (no randomization), and the
+    # trials with seeds 1, 2, ..., so no two runs share a seed
+    log.info("Making template tree")
+    start_worker(context, 0, args.exec, ariadne_args, results, running)
+    template_json = get_result(results, running)
+    template = IndexedNodes(json.loads(template_json))
+    template_sha = sha256(template_json.encode("utf-8")).hexdigest()
+
+    cpus = args.cpus or mp.cpu_count()
     identical = 0
-    with tempfile.TemporaryDirectory() as scratch:
-        # We add the "out_json" and "out_repr" files
-        # the latter is just redirected to be deleted
-        template = f"{scratch}/{uuid.uuid4()}"
-        template_tree = bonsai.Tree.from_node_json(ariadne(target_file=template))
-        with open(template, 'rb') as handle:
-            template_sha = sha256(handle.read()).hexdigest()
-
-        for _ in tqdm(range(args.trials)):
-            response_path = f"{scratch}/{uuid.uuid4()}"
-            response_tree = bonsai.Tree.from_node_json(
-                ariadne(target_file=response_path)
-            )
+    # Keep `cpus` workers running, each with its own seed
+    started = 0
+    for finished in tqdm(range(args.trials)):
+        while started < args.trials and started - finished < cpus:
+            started += 1
+            start_worker(context, started, args.exec, ariadne_args, results, running)
 
-            test_congruency(template_tree, response_tree)
-            ## Ok, if we get here we are congruent. But are we *indentical*?
-            with open(response_path, 'rb') as handle:
-                response_sha = sha256(handle.read()).hexdigest()
+        response_json = get_result(results, running)
+        response = IndexedNodes(json.loads(response_json))
+        test_congruency(template, response)
 
-            if template_sha == response_sha:
-                identical += 1
+        # Ok, if we get here we are congruent. But are we *identical*?
+        identical += sha256(response_json.encode("utf-8")).hexdigest() == template_sha
 
     print(f"Of the tested trees, {identical}/{args.trials} ({identical/args.trials*100:02}%)) were truly identical")
-            
-
 
 
 if __name__ == "__main__":
     import argparse
 
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        epilog="All other arguments are passed to the geneset builder, without the output files."
+    )
 
-    parser.add_argument("exec", help="Path to the executable file")
+    parser.add_argument("exec", help="Path to the geneset builder (make_genesets.py)")
     parser.add_argument("--trials", help="Number of trials to check", type=int)
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        help="Number of trials to run in parallel. If unspecified, uses all available cores.",
+    )
     parser.add_argument("--verbose", help="Increase verbosity", action="store_true")
 
     args, extra = parser.parse_known_args()
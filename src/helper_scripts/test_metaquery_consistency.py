@@ -0,0 +1,166 @@
+"""Check that metaquery.py selects the same samples as metasplit
+
+The ranking modules resolve the DEA queries in-process, with `metaquery.py`,
+instead of running `metasplit`. A difference in how the two read a query
+would silently change which samples end up in the cases and controls, so
+this runs both on every query of a queries file and compares the results.
+
+`metasplit` is run on a one-row copy of the matrix, so this is fast even
+on the whole expression matrix.
+"""
+
+import csv
+import json
+import logging
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from tqdm import tqdm
+
+# The shared readers live in the modules folder
+sys.path.insert(0, str(Path(__file__).parent.parent / "modules"))
+
+from matrix_io import read_header
+from metaquery import CLINICAL_PLACEHOLDER, META_PLACEHOLDER, select_columns
+
+log = logging.getLogger(__name__)
+
+ID_COL = "sample"
+
+
+def run_metasplit(queries, matrix_path, output_path):
+    """Get the columns that metasplit selects from a matrix"""
+    args = [
+        "metasplit",
+        *queries,
+        matrix_path,
+        output_path,
+        "--ignore_missing",
+        "--input_delimiter",
+        ",",
+        "--always_include",
+        ID_COL,
+    ]
+    args = [str(x) for x in args]
+    log.debug(f"Executing {' '.join(args)}")
+    ret = subprocess.run(args, capture_output=True)
+    if ret.returncode != 0:
+        raise RuntimeError(f"metasplit failed to run:\n{ret.stderr.decode('UTF-8')}")
+
+    with output_path.open("r") as stream:
+        header = stream.readline()
+    return next(csv.reader([header], delimiter="\t" if "\t" in header else ","))
+
+
+def expected_columns(queries, intersect, matrix_path, scratch):
+    """Get the columns that the old metasplit calls would have selected
+
+    metasplit joins its queries, so queries that must all match are run
+    one at a time, and the results intersected.
+    """
+    if not intersect:
+        return run_metasplit(queries, matrix_path, scratch / "output")
+
+    selections = [run_metasplit([x], matrix_path, scratch / "output") for x in queries]
+    shared = set.intersection(*(set(x) for x in selections))
+    return [x for x in selections[0] if x in shared]
+
+
+def set_placeholders(query, metadata_path, clinical_path):
+    query = query.replace(META_PLACEHOLDER, str(metadata_path.expanduser().absolute()))
+    if clinical_path is not None:
+        query = query.replace(
+            CLINICAL_PLACEHOLDER, str(clinical_path.expanduser().absolute())
+        )
+    return query
+
+
+def main(args):
+    with args.queries_file.open("r") as stream:
+        queries = json.load(stream)
+
+    columns = read_header(args.input_matrix)
+    log.info(f"Read {len(columns)} columns from {args.input_matrix}")
+
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as scratch:
+        scratch = Path(scratch)
+        # metasplit only needs the header, but give it one row to be safe
+        matrix_path = scratch / "matrix.csv"
+        with matrix_path.open("w", newline="") as stream:
+            writer = csv.writer(stream)
+            writer.writerow(columns)
+            writer.writerow(["dummy"] + [0] * (len(columns) - 1))
+
+        for key, value in tqdm(queries.items()):
+            for part in ("case", "control"):
+                found = select_columns(
+                    value[part],
+                    columns,
+                    metadata_path=args.input_metadata,
+                    always_include=[ID_COL],
+                    clinical_path=args.clinical,
+                    intersect=value.get("and", False),
+                )
+                expected = expected_columns(
+                    [
+                        set_placeholders(x, args.input_metadata, args.clinical)
+                        for x in value[part]
+                    ],
+                    value.get("and", False),
+                    matrix_path,
+                    scratch,
+                )
+
+                if found == expected:
+                    continue
+
+                mismatches += 1
+                log.error(
+                    f"Mismatch in {key} ({part}): "
+                    f"{len(set(found) - set(expected))} samples only in metaquery, "
+                    f"{len(set(expected) - set(found))} only in metasplit"
+                    + (", different order" if set(found) == set(expected) else "")
+                )
+                log.debug(f"metaquery: {found}")
+                log.debug(f"metasplit: {expected}")
+
+    checked = 2 * len(queries)
+    print(f"Of the tested selections, {checked - mismatches}/{checked} were identical")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "queries_file", type=Path, help="JSON file with the queries to check"
+    )
+    parser.add_argument(
+        "input_matrix", type=Path, help="Expression matrix the queries select from"
+    )
+    parser.add_argument(
+        "input_metadata",
+        type=Path,
+        help="Metadata to replace '<meta>' with. Must be a .csv, that metasplit can read.",
+    )
+    parser.add_argument(
+        "--clinical",
+        type=Path,
+        help="Metadata to replace '<clinical>' with. Must be a .csv, as metasplit cannot read indexes.",
+    )
+    parser.add_argument("--verbose", help="Increase verbosity", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    main(args)
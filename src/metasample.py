@@ -5,8 +5,11 @@
 This script performs stratified sampling on an input .csv file, reducing the
 number of columns and rows.
 
-To run, you must install `pandas` and have `xsv` (https://github.com/BurntSushi/xsv)
-in your PATH.
+The input and output can be .csv or .tsv files, optionally gzipped (.gz).
+The input is read in a single pass: the columns are selected through a
+precomputed index, and the rows are sampled with reservoir sampling as they
+are read. Compressed inputs are decompressed on a separate thread, with the
+shared readers in `src/modules/matrix_io.py`.
 """
 
 ## --- LICENSE ---
@@ -36,22 +39,38 @@ in your PATH.
 # For more information, please refer to <https://unlicense.org>
 ## --- ---
 
-from typing import TextIO, Optional
+from typing import TextIO
+import math
 from math import ceil
+from operator import itemgetter
 import pandas as pd
-import subprocess as sb
+import csv
+import gzip
+import random
 from random import sample
 from pathlib import Path
-import os
-import tempfile
 
 import logging
+import sys
+
+# The shared readers live in the modules folder
+sys.path.insert(0, str(Path(__file__).parent / "modules"))
+
+from matrix_io import delimiter_of, open_text, read_header
 
 logging.basicConfig(level=logging.DEBUG)
 
 log = logging.getLogger(__name__)
 
 
+def open_output(path: Path) -> TextIO:
+    """Open a (possibly gzipped) text file for writing"""
+    path = Path(path)
+    if path.suffix == ".gz":
+        return gzip.open(path, "wt", newline="")
+    return path.open("w", newline="")
+
+
 def sample_size_string_to_percentage(sample_size: str, total_size: int) -> int:
     """Convert a sample size string to a percentage.
 
@@ -72,67 +91,63 @@ def sample_size_string_to_percentage(sample_size: str, total_size: int) -> int:
     return sample_size
 
 
-class NumberCompressor:
-    """Compresses sequences of numbers to call xsv in a more concise way
+class Reservoir:
+    """Uniformly sample `size` items from a stream of unknown length
 
-    If the selection was raw (e.g. 1,2,3,4,5) you might hit the cap of command
-    length. Using a compressor makes it so that such long strings are compressed
-    and cause such problems less frequently.
+    This uses "Algorithm L" (Li, 1994), which computes how many items to skip
+    before the next one is taken, instead of drawing a number for every item.
+    Items are added with `offer`, which takes a function that makes the item
+    to store, so that skipped items are never processed.
     """
 
-    def __init__(self) -> None:
-        self.compressed = []
-        self.expected_number = None
-        self.buffer = []
-
-    def flush(self):
-        if not self.buffer:
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.items = []
+        self.seen = 0
+        self.weight = math.exp(math.log(random.random()) / size) if size else 0
+        self.next_taken = size + self._skip()
+
+    def _skip(self) -> int:
+        if not self.size:
+            return 0
+        return math.floor(math.log(random.random()) / math.log(1 - self.weight))
+
+    def offer(self, make_item) -> None:
+        index = self.seen
+        self.seen += 1
+        if not self.size:
             return
-        if len(self.buffer) == 1:
-            self.compressed.append(f"{self.buffer[0]}")
-        else:
-            self.compressed.append(f"{min(self.buffer)}-{max(self.buffer)}")
-        self.buffer = []
-
-    def gobble(self, i: int) -> None:
-        if self.expected_number is None or i == self.expected_number:
-            self.expected_number = i + 1
-            self.buffer.append(i)
+        if index < self.size:
+            self.items.append((index, make_item()))
             return
+        if index != self.next_taken:
+            return
+        self.items[random.randrange(self.size)] = (index, make_item())
+        self.weight *= math.exp(math.log(random.random()) / self.size)
+        self.next_taken += self._skip() + 1
 
-        self.flush()
-        self.buffer.append(i)
-        self.expected_number = i + 1
-
-
-def exec(*args, **kwargs) -> str:
-    res = sb.run(
-        *args, **kwargs, encoding="UTF-8", capture_output=True, errors="replace"
-    )
+    def sorted_items(self) -> list:
+        """The sampled items, in the order they were offered"""
+        return [item for _, item in sorted(self.items, key=lambda x: x[0])]
 
-    if res.returncode != 0:
-        raise OSError(f"Process exited with code {res.returncode}:\n{res.stderr}")
 
-    return res.stdout.strip()
+class BernoulliSampler:
+    """Keep each item of a stream with some probability
 
+    Used when the sample size is a fraction of a stream of unknown length.
+    Has the same interface as `Reservoir`.
+    """
 
-def xsv_select(
-    file: Path,
-    var: str,
-    delim: str = ",",
-    include_header: bool = False,
-    output_file: Optional[Path] = None,
-) -> list[str]:
-    assert file.exists(), f"Cannot run xsv on file {file} that does not exist"
+    def __init__(self, probability: float) -> None:
+        self.probability = probability
+        self.items = []
 
-    command = ["xsv", "select", "-d", delim, var, file.as_posix()]
-    if output_file:
-        command.extend(["-o", output_file.as_posix()])
-    values: list[str] = exec(command).split("\n")
-    if not include_header:
-        values.pop(0)
+    def offer(self, make_item) -> None:
+        if random.random() < self.probability:
+            self.items.append(make_item())
 
-    return values
+    def sorted_items(self) -> list:
+        return self.items
 
 
 def metasample(
@@ -145,21 +160,24 @@ def metasample(
     row_sample_size: str,
     always_include: str,
 ):
+    input_delim = delimiter_of(input)
     log.debug("Reading input header")
-    with input.open("r+") as stream:
-        input_header = stream.readline().split(",")
-    log.debug("Getting input size")
-    with input.open("r+") as stream:
-        input_size = sum(1 for _ in stream)
+    input_header = read_header(input)
 
     log.debug("Parsing variables")
     sample_size = sample_size_string_to_percentage(sample_size, len(input_header))
-    # This is retarded but bear with me
-    row_sample_size = sample_size_string_to_percentage(row_sample_size, input_size)
-    row_sample_size = ceil(row_sample_size * input_size)
+    # We do not know how many rows there are in the input before reading it.
+    # If we are asked for a fraction of rows, keep each row with that
+    # probability. Otherwise, sample that many rows exactly.
+    if row_sample_size.endswith("%"):
+        row_sampler = BernoulliSampler(float(row_sample_size.strip("%")) / 100)
+    else:
+        row_sampler = Reservoir(int(row_sample_size))
 
     log.debug("Reading metadata")
-    metadata = pd.read_csv(metadata, encoding_errors="replace")
+    metadata = pd.read_csv(
+        metadata, sep=delimiter_of(metadata), encoding_errors="replace"
+    )
     log.debug(f"Metadata cols: {metadata.columns.to_list()}")
 
     if not all([x in metadata.columns for x in metavars]):
@@ -177,41 +195,39 @@ def metasample(
     metadata = metadata.set_index(meta_rowname_var)
     groups = metadata.groupby(metavars).apply(get_labels)
 
-    selected = []
+    selected = set()
     log.debug("Sampling groups")
     for group in groups:
         new_group = sample(group, ceil(len(group) * sample_size))
         log.debug(
             f"Sampled group. Was {len(group)}, now is {len(new_group)} ({((len(new_group) - len(group))/len(group))*100:.2f})"
         )
-        selected.extend(new_group)
-
-    always_include = always_include.split(",")
-    selected.extend(always_include)
-
-    log.debug("Compressing selection")
-    compressor = NumberCompressor()
-    for i, item in enumerate(input_header, start=1):
-        if item in selected:
-            compressor.gobble(i)
-
-    compressor.flush()
-
-    with tempfile.NamedTemporaryFile() as temp:
-        log.debug("Executing xsv - selecting columns")
-        compressed_str = ",".join(compressor.compressed)
-        xsv_select(input, compressed_str, include_header=True, output_file=Path(temp.name))
-        log.debug("Executing xsv - sampling rows")
-        exec(
-            [
-                "xsv",
-                "sample",
-                "-o",
-                f"{output.as_posix()}",
-                f"{row_sample_size}",
-                f"{temp.name}",
-            ]
-        )
+        selected.update(new_group)
+
+    if always_include:
+        selected.update(always_include.split(","))
+
+    log.debug("Computing column index")
+    indexes = [i for i, item in enumerate(input_header) if item in selected]
+    if not indexes:
+        raise ValueError("No columns of the input were selected")
+    # itemgetter with one index returns an item, not a tuple
+    select = itemgetter(*indexes) if len(indexes) > 1 else lambda x: (x[indexes[0]],)
+
+    log.debug("Sampling rows")
+    with open_text(input) as stream:
+        next(stream)
+        for line in stream:
+            # Rows are only parsed if they are taken by the sampler
+            row_sampler.offer(
+                lambda: select(next(csv.reader([line], delimiter=input_delim)))
+            )
+
+    log.debug(f"Writing {len(row_sampler.items)} rows")
+    with open_output(output) as stream:
+        writer = csv.writer(stream, delimiter=delimiter_of(output), lineterminator="\n")
+        writer.writerow(select(input_header))
+        writer.writerows(row_sampler.sorted_items())
 
     print("Done!")
 
@@ -222,10 +238,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
-        "input_matrix", help="A path to a csv table to sample", type=Path
+        "input_matrix", help="A path to a csv/tsv (optionally gzipped) table to sample", type=Path
     )
     parser.add_argument(
-        "output_matrix", help="A path to the output csv table to create", type=Path
+        "output_matrix", help="A path to the output csv/tsv (optionally gzipped) table to create", type=Path
     )
     parser.add_argument("metadata", help="A path to the input metadata to consider")
     parser.add_argument(
@@ -253,8 +269,7 @@ if __name__ == "__main__":
     if args.metavars:
         metavars = args.metavars.split(",")
     else:
-        with args.input_matrix.open("r+") as stream:
-            header = next(stream).split(",")
+        header = read_header(args.input_matrix)
         metavars = [x for x in header if x != args.row_names_var]
 
     metasample(
@@ -1,109 +1,49 @@
 import json
-import os
 import sys
-import tempfile
-from functools import partial, reduce
 from pathlib import Path
-from subprocess import run
 
 import pandas as pd
 
-# This is essentially copy-paste the code from select_and_run.py
+from gene_universe import read_universe
+from matrix_io import read_expression, read_header
+from metaquery import select_columns
 
 
-def replace(string, pattern, replacement):
-    string = str(string)
-    return string.replace(str(pattern), str(replacement))
-
-
-def run_wrapper(
-    keyvalue,
-    input_matrix_path,
-    input_metadata_path,
-    output_dir,
-    delimiter,
-    case_only,
-    control_only,
-):
-    key, value = keyvalue
-    set_meta = partial(
-        replace,
-        pattern="<meta>",
-        replacement=input_metadata_path.expanduser().absolute(),
-    )
-    print(f"Processing {key}.")
+def select_samples(
+    key,
+    value,
+    columns: list[str],
+    input_metadata_path: Path,
+    case_only: bool,
+    control_only: bool,
+    clinical_path: Path = None,
+) -> list[str]:
+    print(f"Selecting samples for {key}.")
 
     assert not (
         case_only and control_only
     ), "Cannot set both case_only and control_only"
 
-    # Make the "case" file
+    parts = []
     if not control_only:
-        print(f"Making input file {key}_case")
-        args = [
-            "metasplit",
-        ]
-        args.extend([set_meta(x) for x in value["case"]])
-        args.extend(
-            [
-                input_matrix_path,
-                output_dir / f"{key}_case",
-                "--ignore_missing",
-                "--input_delimiter",
-                delimiter,
-                "--always_include",
-                "sample",
-            ]
-        )
-        args = [str(x) for x in args]
-        print(f"Executing {' '.join(args)}")
-        run(args, check=True)
-        case = pd.read_csv(output_dir / f"{key}_case")
-
-    # Make the "control" file
+        parts.append("case")
     if not case_only:
-        print(f"Making input file {key}_control")
-        args = [
-            "metasplit",
-        ]
-        args.extend([set_meta(x) for x in value["control"]])
-        args.extend(
-            [
-                input_matrix_path,
-                output_dir / f"{key}_control",
-                "--ignore_missing",
-                "--input_delimiter",
-                delimiter,
-                "--always_include",
-                "sample",
-            ]
+        parts.append("control")
+
+    # The case and control are selected like select_and_run.py does, so that
+    # "and" applies to the queries of each, not to all of them together
+    selected = set()
+    for part in parts:
+        selected.update(
+            select_columns(
+                value[part],
+                columns,
+                metadata_path=input_metadata_path,
+                clinical_path=clinical_path,
+                intersect=value.get("and", False),
+            )
         )
-        args = [str(x) for x in args]
-        print(f"Executing {' '.join(args)}")
-        run(args, check=True)
-        control = pd.read_csv(output_dir / f"{key}_control")
-
-    # Merge case and control together, if we need to
-    if case_only:
-        matrix = case
-    elif control_only:
-        matrix = control
-    else:
-        matrix = pd.merge(case, control, on="sample", how="outer")
-
-    # Calculate row means
-    # It's OK to rely on "numeric_only" as all cols except one should be
-    # numeric, and they are all relevant
-    matrix[key] = matrix.mean(axis=1, numeric_only=True)
-    matrix = matrix.filter(items=["sample", key], axis="columns")
-
-    # Delete the useless input files
-    if not control_only:
-        os.remove(output_dir / f"{key}_case")
-    if not case_only:
-        os.remove(output_dir / f"{key}_control")
-
-    return matrix
+    return [x for x in columns if x in selected and x != "sample"]
 
 
 def main(
@@ -111,26 +51,45 @@ def main(
     input_matrix_path: Path,
     input_metadata_path: Path,
     output_path: Path,
-    delimiter=",",
+    delimiter=None,
     case_only=False,
     control_only=False,
+    universe_path=None,
+    clinical_path=None,
 ):
-    with tempfile.TemporaryDirectory() as tmp:
-        run = partial(
-            run_wrapper,
-            input_matrix_path=input_matrix_path,
+    header = read_header(input_matrix_path, delimiter=delimiter)
+    samples = {
+        key: select_samples(
+            key,
+            value,
+            columns=header,
             input_metadata_path=input_metadata_path,
-            output_dir=Path(tmp),
-            delimiter=delimiter,
             case_only=case_only,
             control_only=control_only,
+            clinical_path=clinical_path,
         )
-        matrices = list(map(run, queries.items()))
-
-    result: pd.DataFrame = reduce(
-        lambda x, y: pd.merge(x, y, how="outer", on="sample"), matrices
+        for key, value in queries.items()
+    }
+
+    # Only read the samples that we need
+    needed = set().union(*samples.values())
+    matrix = read_expression(
+        input_matrix_path,
+        columns=["sample"] + [x for x in header if x in needed],
+        id_cols=["sample"],
+        delimiter=delimiter,
     )
 
+    means = [
+        matrix[columns].mean(axis=1).rename(key) for key, columns in samples.items()
+    ]
+
+    result = pd.concat([matrix["sample"], *means], axis=1)
+    if universe_path is not None:
+        result = read_universe(universe_path).align(result, "sample")
+    else:
+        result = result.sort_values("sample", ignore_index=True)
+
     result.to_csv(output_path, index=False)
 
 
@@ -143,13 +102,28 @@ if __name__ == "__main__":
         "queries_file", type=Path, help="JSON file with the queries to launch"
     )
     parser.add_argument(
-        "input_matrix", type=Path, help="Input (big) expression matrix to subset"
+        "input_matrix",
+        type=Path,
+        help="Input (big) expression matrix to subset. Can be gzipped.",
     )
     parser.add_argument(
         "input_metadata", type=Path, help="Input metadata matrix to use to subset"
     )
     parser.add_argument("output_file", type=Path, help="Output .csv file path")
-    parser.add_argument("--delimiter", default=",", help="Delimiter for the input")
+    parser.add_argument(
+        "--delimiter",
+        help="Delimiter for the input. If unspecified, it is guessed from the extension.",
+    )
+    parser.add_argument(
+        "--universe",
+        type=Path,
+        help="Gene universe (.arrow, see gene_universe.py) to key and order the genes by",
+    )
+    parser.add_argument(
+        "--clinical",
+        type=Path,
+        help="Clinical metadata index (.arrow) for the <clinical> queries",
+    )
     parser.add_argument(
         "--case-only",
         action="store_true",
@@ -178,4 +152,6 @@ if __name__ == "__main__":
         delimiter=args.delimiter,
         case_only=args.case_only,
         control_only=args.control_only,
+        universe_path=args.universe,
+        clinical_path=args.clinical,
     )
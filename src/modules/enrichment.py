@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+"""Pre-ranked gene set enrichment, for many rankings and genesets at once
+
+This does what `run_gsea.R` does with fgsea, in the same process that makes
+the rankings, so they are enriched straight from memory:
+    - the rankings are cleaned like `extract_ranks` does: the ENSG versions
+      are stripped, and only the protein coding genes are kept;
+    - the enrichment score (ES) of a set is the maximum deviation from zero
+      of the running sum over the sorted ranking, with the hits weighted by
+      |statistic| ** p (p = 1, or 0 if unweighted);
+    - the p-values come from a null of random sets of the same size. The
+      random sets are drawn once and reused for all rankings, and the NES
+      is the ES divided by the mean null ES of the same sign, like in fgsea.
+
+The random sets and the null ES of each set size can be kept in a cache
+folder (see `NullCache`), to be reused by the next runs. The random sets only
+depend on the number of genes in the ranking, and so do the null ES of
+unweighted runs (signed or absolute), so these are shared by all rankings of
+all methods. The weighted null ES also depend on the statistic, so they could
+only be reused for the very same ranking: they are computed for each ranking,
+and never kept.
+
+All the sets of the same size are scored together, as a single matrix of
+positions in the ranking, and so are their random sets. The signed and the
+absolute enrichments are made from the same cleaned rankings.
+
+The output tables have the same columns that the plots read from the fgsea
+tables (`pathway`, `pval`, `padj`, `ES`, `NES`, `size`, `leadingEdge`).
+
+Run this as a script to enrich a folder of ranking files.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from gene_universe import GeneUniverse, read_universe
+
+log = logging.getLogger(__name__)
+
+ENSG_VERSION = r"\.[0-9]+$"
+# Separator of the genes in the `leadingEdge` column
+EDGE_SEP = "|"
+
+
+def load_genesets(path: Path) -> dict[str, list[str]]:
+    """Load the genesets of a node JSON, as node ID -> genes
+
+    Nodes without data (`"data": null`) are loaded as empty sets.
+    """
+    with Path(path).open("r") as stream:
+        nodes = json.load(stream)
+    return {node_id: node["data"] or [] for node_id, node in nodes.items()}
+
+
+def load_coding_genes(path: Path) -> set[str]:
+    """Get the protein coding genes of a biomart table (the `ensg_data.csv`)"""
+    data = pd.read_csv(path, usecols=["ensembl_gene_id", "gene_biotype"])
+    return set(data["ensembl_gene_id"][data["gene_biotype"] == "protein_coding"])
+
+
+def clean_ranking(
+    ranking: pd.Series,
+    coding: Optional[set[str]] = None,
+    absolute: bool = False,
+    universe: Optional[GeneUniverse] = None,
+) -> pd.Series:
+    """Prepare a ranking (gene ID -> statistic) for enrichment
+
+    Strips the ENSG versions (keeping the first of any duplicates), keeps
+    only the `coding` genes (if given, or the coding genes of the `universe`),
+    sets missing values to zero and sorts the statistic in decreasing order.
+    """
+    ranking = ranking.copy()
+    ranking.index = pd.Index(ranking.index.astype(str)).str.replace(
+        ENSG_VERSION, "", regex=True
+    )
+    ranking = ranking[~ranking.index.duplicated(keep="first")]
+    if coding is not None:
+        ranking = ranking[ranking.index.isin(coding)]
+    elif universe is not None:
+        positions = universe.positions(ranking.index)
+        ranking = ranking[(positions >= 0) & universe.coding[positions]]
+    if ranking.isna().any():
+        log.warning("Some values in the ranking are NA. Setting to 0")
+        ranking = ranking.fillna(0)
+    ranking = ranking.astype(np.float64)
+    if absolute:
+        ranking = ranking.abs()
+    return ranking.sort_values(ascending=False, kind="stable")
+
+
+def enrichment_scores(
+    weights: np.ndarray, positions: np.ndarray, unweighted: bool = False
+) -> tuple[np.ndarray, np.ndarray]:
+    """Compute the ES of many sets of the same size on one sorted ranking
+
+    Args:
+        weights (np.ndarray): The statistic, sorted in decreasing order.
+        positions (np.ndarray): One row per set, with the (sorted) positions
+          of the genes of the set in the ranking.
+        unweighted (bool): Weight all the hits the same.
+
+    Returns the ES of each set, and the position in the row of the hit where
+    the running sum peaks.
+    """
+    n_genes = len(weights)
+    n_sets, size = positions.shape
+    if unweighted:
+        hits = np.ones(positions.shape)
+    else:
+        hits = np.abs(weights[positions])
+        # A set of all-zero statistics has nothing to weight by
+        hits[hits.sum(axis=1) == 0] = 1
+    hits /= hits.sum(axis=1, keepdims=True)
+
+    # The running sum right after and right before each hit. It is lowest
+    # just before a hit, and highest just after one.
+    misses = (positions - np.arange(size)) / (n_genes - size)
+    after = np.cumsum(hits, axis=1) - misses
+    before = after - hits
+
+    top = after.argmax(axis=1)
+    bottom = before.argmin(axis=1)
+    rows = np.arange(n_sets)
+    highest = after[rows, top]
+    lowest = before[rows, bottom]
+
+    positive = highest > -lowest
+    scores = np.where(positive, np.maximum(highest, 0), np.minimum(lowest, 0))
+    peaks = np.where(positive, top, bottom)
+    return scores, peaks
+
+
+def random_draws(
+    n_genes: int, width: int, permutations: int, seed: int
+) -> np.ndarray:
+    """Draw the first `width` positions of many random permutations
+
+    The first `size` columns are then a random set of any `size` <= `width`,
+    so a single draw serves all the set sizes. The permutations only depend
+    on the seed and `n_genes`, so draws with a larger `width` extend the
+    smaller ones.
+    """
+    rng = np.random.default_rng([seed, n_genes])
+    draws = np.empty((permutations, width), dtype=np.int32)
+    # In chunks, so that the full permutations are never all in memory
+    chunk = max(1, 2**22 // n_genes)
+    for start in range(0, permutations, chunk):
+        stop = min(start + chunk, permutations)
+        order = np.tile(np.arange(n_genes, dtype=np.int32), (stop - start, 1))
+        draws[start:stop] = rng.permuted(order, axis=1)[:, :width]
+    return draws
+
+
+def adjust_bh(pvalues: np.ndarray) -> np.ndarray:
+    """Adjust p-values with the Benjamini-Hochberg method"""
+    n = len(pvalues)
+    if n == 0:
+        return pvalues
+    order = np.argsort(pvalues)
+    adjusted = pvalues[order] * n / np.arange(1, n + 1)
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    result = np.empty(n)
+    result[order] = np.minimum(adjusted, 1)
+    return result
+
+
+class NullCache:
+    """A folder with the random sets and the null ES of past runs
+
+    The random sets are saved as `draws-<genes>-<permutations>-<seed>.npy`,
+    and memory mapped when read. The null ES are saved together for all set
+    sizes in `null-<variant>-<permutations>-<seed>.npz` files, where the
+    variant is `unweighted-<genes>`. Weighted null ES are never saved.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _save(self, target: Path, save: callable):
+        # Write to a temporary file first, so that readers never see half of it
+        handle, tmp_path = tempfile.mkstemp(dir=self.path, suffix=target.suffix)
+        os.close(handle)
+        try:
+            save(tmp_path)
+            os.replace(tmp_path, target)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def draws(self, n_genes: int, width: int, permutations: int, seed: int) -> np.ndarray:
+        target = self.path / f"draws-{n_genes}-{permutations}-{seed}.npy"
+        if target.exists():
+            draws = np.load(target, mmap_mode="r")
+            if draws.shape[1] >= width:
+                return draws
+        log.info(f"Drawing {permutations} random sets of up to {width} genes...")
+        draws = random_draws(n_genes, width, permutations, seed)
+        self._save(target, lambda x: np.save(x, draws))
+        return draws
+
+    def nulls(self, variant: str, permutations: int, seed: int) -> dict[int, np.ndarray]:
+        target = self.path / f"null-{variant}-{permutations}-{seed}.npz"
+        if not target.exists():
+            return {}
+        with np.load(target) as data:
+            return {int(key.removeprefix("size_")): data[key] for key in data.files}
+
+    def save_nulls(
+        self, variant: str, permutations: int, seed: int, nulls: dict[int, np.ndarray]
+    ):
+        target = self.path / f"null-{variant}-{permutations}-{seed}.npz"
+        arrays = {f"size_{size}": scores for size, scores in nulls.items()}
+        self._save(target, lambda x: np.savez(x, **arrays))
+
+
+class Enricher:
+    """Enrich many rankings with the same genesets
+
+    The random sets for the null are drawn the first time that a ranking of
+    a given length is enriched, and then reused for all set sizes. The null
+    ES of each set size are computed once per variant (see `NullCache`), or
+    once per ranking if weighted.
+
+    With a `universe`, the genesets are turned to gene indexes once, and the
+    genes of the sets are found in each ranking by position.
+    """
+
+    def __init__(
+        self,
+        genesets: dict[str, list[str]],
+        permutations: int = 1000,
+        unweighted: bool = False,
+        seed: int = 42,
+        cache: Optional[NullCache] = None,
+        universe: Optional[GeneUniverse] = None,
+    ):
+        self.genesets = genesets
+        self.universe = universe
+        if universe is not None:
+            self._members = {}
+            for set_id, members in genesets.items():
+                indexes = universe.positions(members)
+                self._members[set_id] = np.unique(indexes[indexes >= 0])
+        self.permutations = permutations
+        self.unweighted = unweighted
+        self.seed = seed
+        self.cache = cache
+        self.max_size = max((len(x) for x in genesets.values()), default=0)
+        self._draws = {}
+        self._positions = {}
+        self._nulls = {}
+
+    def null_positions(self, n_genes: int, size: int) -> np.ndarray:
+        """Get the (sorted) positions of the random sets of a size"""
+        key = (n_genes, size)
+        if key not in self._positions:
+            if n_genes not in self._draws:
+                width = min(self.max_size, n_genes)
+                if self.cache is not None:
+                    draws = self.cache.draws(n_genes, width, self.permutations, self.seed)
+                else:
+                    draws = random_draws(n_genes, width, self.permutations, self.seed)
+                self._draws[n_genes] = draws
+            self._positions[key] = np.sort(self._draws[n_genes][:, :size], axis=1)
+        return self._positions[key]
+
+    def variant_of(self, weights: np.ndarray) -> Optional[str]:
+        """Get the name of the null distributions that fit a sorted ranking
+
+        Weighted null ES fit only the ranking they were made with, so they
+        have no name (None), and are not shared.
+        """
+        if self.unweighted:
+            # Only the positions matter, and they only depend on the length
+            return f"unweighted-{len(weights)}"
+        return None
+
+    def nulls_of(self, variant: Optional[str]) -> dict[int, np.ndarray]:
+        if variant is None:
+            return {}
+        if variant not in self._nulls:
+            cached = {}
+            if self.cache is not None:
+                cached = self.cache.nulls(variant, self.permutations, self.seed)
+            self._nulls[variant] = cached
+        return self._nulls[variant]
+
+    def null_scores(
+        self, weights: np.ndarray, size: int, nulls: dict[int, np.ndarray]
+    ) -> np.ndarray:
+        """Get the ES of the random sets of a size on a sorted ranking
+
+        The scores are looked up in (and added to) `nulls`, see `nulls_of`.
+        """
+        if size not in nulls:
+            positions = self.null_positions(len(weights), size)
+            nulls[size], _ = enrichment_scores(weights, positions, self.unweighted)
+        return nulls[size]
+
+    def set_positions(self, ranking: pd.Series) -> dict[str, np.ndarray]:
+        """Find the (sorted) positions of the genes of each set in a ranking"""
+        if self.universe is None:
+            where = pd.Series(np.arange(len(ranking)), index=ranking.index)
+            result = {}
+            for set_id, members in self.genesets.items():
+                positions = where.reindex(members).dropna().unique()
+                result[set_id] = np.sort(positions).astype(np.int64)
+            return result
+
+        # Universe index -> position in the ranking (or -1)
+        indexes = self.universe.positions(ranking.index)
+        where = np.full(len(self.universe), -1, dtype=np.int64)
+        known = indexes >= 0
+        where[indexes[known]] = np.arange(len(ranking))[known]
+        result = {}
+        for set_id, members in self._members.items():
+            positions = where[members]
+            result[set_id] = np.sort(positions[positions >= 0])
+        return result
+
+    def enrich(self, ranking: pd.Series) -> pd.DataFrame:
+        """Enrich one (cleaned, see `clean_ranking`) ranking with all sets"""
+        weights = ranking.to_numpy()
+        genes = ranking.index.to_numpy()
+        variant = self.variant_of(weights)
+        nulls = self.nulls_of(variant)
+        known_sizes = set(nulls)
+
+        # The positions of the genes of each set, grouped by set size
+        by_size = {}
+        for set_id, positions in self.set_positions(ranking).items():
+            # Sets that are empty or the whole ranking cannot be scored
+            if len(positions) == 0 or len(positions) >= len(ranking):
+                continue
+            by_size.setdefault(len(positions), []).append((set_id, positions))
+
+        rows = []
+        for size, sets in by_size.items():
+            positions = np.stack([x for _, x in sets])
+            scores, peaks = enrichment_scores(weights, positions, self.unweighted)
+            null = self.null_scores(weights, size, nulls)
+            null_positive = null[null >= 0]
+            null_negative = null[null < 0]
+
+            for (set_id, set_positions), score, peak in zip(sets, scores, peaks):
+                if score >= 0:
+                    pval = (np.sum(null_positive >= score) + 1) / (len(null_positive) + 1)
+                    mean = null_positive.mean() if len(null_positive) else np.nan
+                    edge = set_positions[: peak + 1]
+                else:
+                    pval = (np.sum(null_negative <= score) + 1) / (len(null_negative) + 1)
+                    mean = -null_negative.mean() if len(null_negative) else np.nan
+                    edge = set_positions[peak:][::-1]
+                rows.append(
+                    {
+                        "pathway": set_id,
+                        "pval": pval,
+                        "ES": score,
+                        "NES": score / mean if mean else np.nan,
+                        "size": size,
+                        "leadingEdge": EDGE_SEP.join(genes[edge]),
+                    }
+                )
+
+        result = pd.DataFrame(
+            rows, columns=["pathway", "pval", "ES", "NES", "size", "leadingEdge"]
+        )
+        result.insert(2, "padj", adjust_bh(result["pval"].to_numpy(dtype=float)))
+
+        if self.cache is not None and variant is not None and set(nulls) != known_sizes:
+            self.cache.save_nulls(variant, self.permutations, self.seed, nulls)
+
+        return result
+
+
+def enrich_all(
+    rankings: dict[str, pd.Series],
+    genesets: dict[str, list[str]],
+    coding: Optional[set[str]] = None,
+    output_dir: Optional[Path] = None,
+    absolute_output_dir: Optional[Path] = None,
+    permutations: int = 1000,
+    unweighted: bool = False,
+    seed: int = 42,
+    cache_dir: Optional[Path] = None,
+    universe: Optional[GeneUniverse] = None,
+):
+    """Enrich many rankings, saving the signed and/or absolute enrichments
+
+    The tables are saved as `<name>.csv` in the output folders, with the
+    names of the rankings. The random sets are shared by all the rankings,
+    signed or absolute, and by the next runs if there is a `cache_dir`.
+    """
+    cache = NullCache(cache_dir) if cache_dir is not None else None
+    enricher = Enricher(genesets, permutations, unweighted, seed, cache, universe)
+    targets = [(output_dir, False), (absolute_output_dir, True)]
+    for target, absolute in targets:
+        if target is not None:
+            Path(target).mkdir(parents=True, exist_ok=True)
+
+    for name, ranking in rankings.items():
+        for target, absolute in targets:
+            if target is None:
+                continue
+            log.info(f"Enriching {name}{' (absolute)' if absolute else ''}...")
+            result = enricher.enrich(clean_ranking(ranking, coding, absolute, universe))
+            result.to_csv(Path(target) / f"{name}.csv", index=False)
+
+
+def read_ranking(path: Path, id_col: str = "sample", rank_col: str = "ranking") -> pd.Series:
+    """Read a ranking file (like the ones of `generanker`) as gene ID -> statistic"""
+    data = pd.read_csv(path, usecols=[id_col, rank_col])
+    return data.set_index(id_col)[rank_col]
+
+
+def main(args):
+    genesets = load_genesets(args.genesets)
+    log.info(f"Loaded {len(genesets)} genesets.")
+    coding = load_coding_genes(args.ensg_data) if args.ensg_data else None
+    universe = read_universe(args.universe) if args.universe else None
+
+    rankings = {
+        path.name.removesuffix(".csv"): read_ranking(path, args.id_col)
+        for path in sorted(args.input_dir.glob("*.csv"))
+    }
+    log.info(f"Found {len(rankings)} ranking files.")
+
+    enrich_all(
+        rankings,
+        genesets,
+        coding,
+        output_dir=args.output_dir,
+        absolute_output_dir=args.absolute_output_dir,
+        permutations=args.permutations,
+        unweighted=args.unweighted,
+        seed=args.seed,
+        cache_dir=args.cache_dir,
+        universe=universe,
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("input_dir", type=Path, help="Folder with the ranking .csv files")
+    parser.add_argument("genesets", type=Path, help="JSON file with the genesets tree")
+    parser.add_argument(
+        "--output-dir", type=Path, help="Save the (signed) enrichments here"
+    )
+    parser.add_argument(
+        "--absolute-output-dir",
+        type=Path,
+        help="Save the enrichments on the absolute values of the rankings here",
+    )
+    parser.add_argument(
+        "--ensg-data",
+        type=Path,
+        help="A .csv with the 'ensembl_gene_id' and 'gene_biotype' columns, to keep only protein coding genes",
+    )
+    parser.add_argument(
+        "--universe",
+        type=Path,
+        help="Gene universe (.arrow, see gene_universe.py), to keep only protein coding genes and find the genes by index",
+    )
+    parser.add_argument("--id-col", default="sample", help="Column with the gene IDs in the rankings")
+    parser.add_argument("--unweighted", action="store_true", help="Run the enrichment in an unweighted manner")
+    parser.add_argument("--permutations", type=int, default=1000, help="Number of random sets for the p-values")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for the random sets")
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help="Keep the random sets and null distributions in this folder, and reuse them",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Canonical index of the genes, shared by all the modules of a run
+
+The expression matrices, the rankings and the genesets all use ENSG IDs,
+some with versions and some without, and each module used to strip the
+versions and look up the protein coding genes in `ensg_data.csv` on its own.
+
+The universe is built once per run from `ensg_data.csv`: one row per
+versionless ENSG ID (sorted), with its HUGO symbol and biotype. The number of
+the row is the dense integer index of the gene. It is saved as an
+uncompressed Arrow file, so that the modules can memory map it.
+
+The modules that get a universe emit their outputs keyed by the versionless
+IDs and ordered by the index, so that later joins can go by position.
+
+Run this as a script to build the universe.
+"""
+
+from __future__ import annotations
+
+import logging
+from functools import cache
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+log = logging.getLogger(__name__)
+
+ENSG_VERSION = r"\.[0-9]+$"
+CODING = "protein_coding"
+
+
+def strip_versions(ids: Iterable[str]) -> pd.Index:
+    """Remove the version suffixes (like `.12`) from some ENSG IDs"""
+    return pd.Index(ids, dtype=str).str.replace(ENSG_VERSION, "", regex=True)
+
+
+def build_universe(ensg_data: Path) -> pd.DataFrame:
+    """Build the universe from a biomart table (the `ensg_data.csv`)
+
+    The table has one row per gene and symbol, so only the first symbol of
+    each gene is kept.
+    """
+    data = pd.read_csv(
+        ensg_data,
+        usecols=["ensembl_gene_id", "hgnc_symbol", "gene_biotype"],
+        dtype=str,
+        keep_default_na=False,
+    )
+    data["gene_id"] = strip_versions(data["ensembl_gene_id"])
+    data = data.drop_duplicates("gene_id", keep="first")
+    data = data.sort_values("gene_id", ignore_index=True)
+    return data[["gene_id", "hgnc_symbol", "gene_biotype"]]
+
+
+def write_universe(universe: pd.DataFrame, path: Path) -> None:
+    table = pa.Table.from_pandas(universe, preserve_index=False)
+    # No compression, or the file could not be memory mapped
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+class GeneUniverse:
+    """The genes of a universe, and where they are in it"""
+
+    def __init__(self, table: pa.Table):
+        self.table = table
+        self.ids = pd.Index(table["gene_id"].to_numpy(zero_copy_only=False))
+        self.coding = (
+            table["gene_biotype"].to_numpy(zero_copy_only=False) == CODING
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def positions(self, ids: Iterable[str]) -> np.ndarray:
+        """Get the index of some (possibly versioned) IDs, -1 if unknown"""
+        return self.ids.get_indexer(strip_versions(ids))
+
+    def align(self, frame: pd.DataFrame, id_col: str) -> pd.DataFrame:
+        """Key a frame by versionless IDs, with the rows in universe order
+
+        Genes that are not in the universe are kept, after all the others
+        (in their original order). Of the genes with the same versionless
+        ID, only the first is kept, and the others are logged.
+        """
+        ids = strip_versions(frame[id_col])
+        keep = ~ids.duplicated(keep="first")
+        if not keep.all():
+            dropped = frame[id_col][~keep].astype(str)
+            log.warning(
+                f"Dropped {len(dropped)} rows with the same versionless ID as an "
+                f"earlier row: {', '.join(dropped)}"
+            )
+        frame = frame[keep].copy()
+        frame[id_col] = ids[keep]
+
+        positions = self.ids.get_indexer(frame[id_col])
+        positions[positions < 0] = len(self)
+        order = np.argsort(positions, kind="stable")
+        return frame.iloc[order].reset_index(drop=True)
+
+
+@cache
+def read_universe(path: Path) -> GeneUniverse:
+    """Memory map (and keep around) a universe saved with `write_universe`"""
+    table = pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+    return GeneUniverse(table)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "ensg_data",
+        type=Path,
+        help="A .csv with the 'ensembl_gene_id', 'hgnc_symbol' and 'gene_biotype' columns",
+    )
+    parser.add_argument("output", type=Path, help="Where to save the universe (.arrow)")
+
+    args = parser.parse_args()
+
+    write_universe(build_universe(args.ensg_data), args.output)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""Indexed binary store for the genesets made by `make_genesets.py`
+
+Pulling a single geneset out of `genesets.json` means parsing the whole file.
+The store holds the same genesets in a binary layout that can be memory
+mapped, with two hash tables to find a geneset by name or by path (the names
+of the nodes from the root, joined by `/`) in constant time.
+
+Layout (all integers are little-endian):
+    - header (see `HEADER`);
+    - the gene table, one null-padded ID of `gene_width` bytes per gene
+      (at least one byte, so that numpy can read it);
+    - the records, one per geneset (see `RECORD`), with the location of the
+      name, path and node ID in the strings blob and the location of the
+      members in the members array;
+    - the name and path hash tables, `n_slots` uint32 each, holding the
+      record index + 1 (0 is an empty slot), with linear probing;
+    - the members, an int32 array of indexes in the gene table;
+    - the strings blob, UTF-8 encoded.
+
+Run this as a script to fetch a geneset from a store.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import json
+import mmap
+import struct
+import sys
+import zlib
+from pathlib import Path
+from typing import Optional, TextIO
+
+import numpy
+
+MAGIC = b"TPGS"
+VERSION = 1
+PATH_SEP = "/"
+
+# magic, version, n_genes, gene_width, n_sets, n_slots, then the offsets of
+# the genes, records, name slots, path slots, members and strings
+HEADER = struct.Struct("<4sIIIII6Q")
+# name, path and id (offset, length) in the blob, members (start, count)
+RECORD = struct.Struct("<QIQIQIQI")
+
+
+def node_paths(nodes: dict) -> dict[str, str]:
+    """Compute the path of all nodes in a node JSON"""
+    paths = {}
+
+    def path_of(node_id: str) -> str:
+        if node_id in paths:
+            return paths[node_id]
+        node = nodes[node_id]
+        if node["parent"] is None:
+            path = node["name"]
+        else:
+            path = path_of(node["parent"]) + PATH_SEP + node["name"]
+        paths[node_id] = path
+        return path
+
+    for node_id in nodes:
+        path_of(node_id)
+
+    return paths
+
+
+def slot_of(key: bytes, n_slots: int) -> int:
+    return zlib.crc32(key) & (n_slots - 1)
+
+
+def make_slots(keys: list[bytes], n_slots: int) -> numpy.ndarray:
+    slots = numpy.zeros(n_slots, dtype="<u4")
+    for i, key in enumerate(keys):
+        slot = slot_of(key, n_slots)
+        while slots[slot]:
+            slot = (slot + 1) & (n_slots - 1)
+        slots[slot] = i + 1
+    return slots
+
+
+def write_store(nodes: dict, stream) -> None:
+    """Write a node JSON (as loaded from `genesets.json`) to a binary stream"""
+    paths = node_paths(nodes)
+    genes = sorted({gene for node in nodes.values() for gene in node["data"] or []})
+    codes = {x: i for i, x in enumerate(genes)}
+    encoded_genes = [x.encode("utf-8") for x in genes]
+    gene_width = max((len(x) for x in encoded_genes), default=1)
+
+    # Keep at most half the slots full, so probe chains stay short
+    n_slots = 1
+    while n_slots < 2 * len(nodes):
+        n_slots *= 2
+
+    blob = io.BytesIO()
+
+    def add_string(string: str) -> tuple[int, int]:
+        encoded = string.encode("utf-8")
+        offset = blob.tell()
+        blob.write(encoded)
+        return offset, len(encoded)
+
+    records = []
+    members = []
+    names = []
+    all_paths = []
+    for node_id, node in nodes.items():
+        data = [codes[x] for x in node["data"] or []]
+        records.append(
+            RECORD.pack(
+                *add_string(node["name"]),
+                *add_string(paths[node_id]),
+                *add_string(node_id),
+                len(members),
+                len(data),
+            )
+        )
+        members.extend(data)
+        names.append(node["name"].encode("utf-8"))
+        all_paths.append(paths[node_id].encode("utf-8"))
+
+    gene_table = numpy.array(encoded_genes, dtype=f"S{gene_width}")
+    sections = [
+        gene_table.tobytes() if genes else b"",
+        b"".join(records),
+        make_slots(names, n_slots).tobytes(),
+        make_slots(all_paths, n_slots).tobytes(),
+        numpy.array(members, dtype="<i4").tobytes(),
+        blob.getvalue(),
+    ]
+
+    offsets = []
+    position = HEADER.size
+    for section in sections:
+        offsets.append(position)
+        position += len(section)
+
+    stream.write(
+        HEADER.pack(
+            MAGIC, VERSION, len(genes), gene_width, len(nodes), n_slots, *offsets
+        )
+    )
+    for section in sections:
+        stream.write(section)
+
+
+def write_gmt(nodes: dict, stream: TextIO) -> None:
+    """Write a node JSON as a .gmt file
+
+    The name of each geneset is the node ID (like in the node JSON) and the
+    description is the path of the node.
+    """
+    paths = node_paths(nodes)
+    for node_id, node in nodes.items():
+        stream.write("\t".join([node_id, paths[node_id], *(node["data"] or [])]))
+        stream.write("\n")
+
+
+class GenesetStore:
+    """Read-only, memory-mapped access to a geneset store"""
+
+    def __init__(self, path: Path) -> None:
+        with Path(path).open("rb") as stream:
+            self.map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic,
+            version,
+            self.n_genes,
+            self.gene_width,
+            self.n_sets,
+            self.n_slots,
+            self.genes_offset,
+            self.records_offset,
+            self.name_slots_offset,
+            self.path_slots_offset,
+            self.members_offset,
+            self.strings_offset,
+        ) = HEADER.unpack_from(self.map, 0)
+
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a geneset store")
+        if version != VERSION:
+            raise ValueError(f"Unsupported geneset store version {version}")
+
+    def __len__(self) -> int:
+        return self.n_sets
+
+    def close(self) -> None:
+        self.map.close()
+
+    def __enter__(self) -> GenesetStore:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self.strings_offset + offset
+        return self.map[start : start + length].decode("utf-8")
+
+    def _record(self, index: int) -> tuple:
+        return RECORD.unpack_from(self.map, self.records_offset + index * RECORD.size)
+
+    def _find(self, key: str, slots_offset: int, field: int) -> list[int]:
+        """Find all records whose `field`th string is `key`"""
+        encoded = key.encode("utf-8")
+        found = []
+        slot = slot_of(encoded, self.n_slots)
+        while True:
+            (value,) = struct.unpack_from("<I", self.map, slots_offset + slot * 4)
+            if value == 0:
+                return found
+            record = self._record(value - 1)
+            if self._string(*record[field * 2 : field * 2 + 2]) == key:
+                found.append(value - 1)
+            slot = (slot + 1) & (self.n_slots - 1)
+
+    def _members(self, index: int) -> list[str]:
+        start, count = self._record(index)[6:]
+        codes = numpy.frombuffer(
+            self.map,
+            dtype="<i4",
+            count=count,
+            offset=self.members_offset + start * 4,
+        )
+        genes = numpy.frombuffer(
+            self.map,
+            dtype=f"S{max(self.gene_width, 1)}",
+            count=self.n_genes,
+            offset=self.genes_offset,
+        )
+        return [x.decode("utf-8") for x in genes[codes]]
+
+    def paths_named(self, name: str) -> list[str]:
+        """Get the paths of all genesets with some name"""
+        records = self._find(name, self.name_slots_offset, 0)
+        return [self._string(*self._record(x)[2:4]) for x in records]
+
+    def get(self, name: Optional[str] = None, path: Optional[str] = None) -> list[str]:
+        """Get the genes in a geneset, by name or by path
+
+        Raises a KeyError if the geneset does not exist, and a ValueError if
+        more than one geneset has that name (use the path instead).
+        """
+        if (name is None) == (path is None):
+            raise ValueError("Specify exactly one of name or path")
+
+        if name is not None:
+            records = self._find(name, self.name_slots_offset, 0)
+            if len(records) > 1:
+                raise ValueError(
+                    f"There are {len(records)} genesets named {name}: "
+                    f"{self.paths_named(name)}. Select one by path."
+                )
+        else:
+            records = self._find(path, self.path_slots_offset, 1)
+
+        if not records:
+            raise KeyError(f"No geneset with {'name' if name else 'path'} {name or path}")
+
+        return self._members(records[0])
+
+    def get_all(self, name: str) -> list[list[str]]:
+        """Get the genes in all the genesets with some name, in store order
+
+        Raises a KeyError if there is no geneset with that name.
+        """
+        records = sorted(self._find(name, self.name_slots_offset, 0))
+        if not records:
+            raise KeyError(f"No geneset with name {name}")
+        return [self._members(x) for x in records]
+
+
+def main(args) -> None:
+    # Like the `jq` filters this replaces, names select all the genesets
+    # with that name, one after the other
+    with GenesetStore(args.store) as store:
+        if args.name is not None:
+            genesets = store.get_all(args.name)
+        else:
+            genesets = [store.get(path=args.path)]
+
+    for genes in genesets:
+        match args.format:
+            case "csv":
+                # Same as `jq -r '@csv'`
+                writer = csv.writer(
+                    sys.stdout, quoting=csv.QUOTE_ALL, lineterminator="\n"
+                )
+                writer.writerow(genes)
+            case "json":
+                json.dump(genes, sys.stdout, indent=2)
+                sys.stdout.write("\n")
+            case "lines":
+                for gene in genes:
+                    print(gene)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fetch a geneset from a store")
+
+    parser.add_argument("store", type=Path, help="Geneset store to read")
+    selection = parser.add_mutually_exclusive_group(required=True)
+    selection.add_argument(
+        "--name", help="Name of the geneset(s) to fetch. All matches are output."
+    )
+    selection.add_argument(
+        "--path", help=f"Path of the geneset to fetch, with names joined by '{PATH_SEP}'"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["csv", "json", "lines"],
+        default="lines",
+        help="Output format: one CSV row, a JSON array or one gene per line (per geneset)",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -3,7 +3,8 @@ After hours of trying to find a fix for the horrible, horrible metadata
 headers, I've chosen to fuck it, and do all of them manually.
 
 This takes the original metadata file and the accession number and spits out
-the fixed metadata.
+the fixed metadata. Give it many metadata files and an output dir to fix them
+all in one go.
 
 Just for fun, I wanted to do this with as little state as I could, so it's
 function fest!
@@ -20,11 +21,6 @@ def eprint(*args, **kwargs):
     print(*args, **kwargs, file=sys.stderr)
 
 
-def lmap(*args, **kwargs):
-    """A not lazy map which converts immediately to a list"""
-    return list(map(*args, **kwargs))
-
-
 def identity(original: Any) -> Any:
     """No-op. Take the input and return the output"""
     return original
@@ -51,8 +47,8 @@ def apply_at(column: str, callable: Callable) -> Callable:
 def take_field(sep: str, position: int) -> Callable:
     """Split a string with `sep` and take the field at `position`"""
 
-    def wrapped(data: Iterable):
-        return lmap(lambda x: x.split(sep)[position], data)
+    def wrapped(data: pd.Series):
+        return data.str.split(sep, regex=False).str[position]
 
     return wrapped
 
@@ -69,54 +65,69 @@ def chain(*args):
 
 
 def replace(_from: str, to: str) -> Callable:
-    """Replace all of `_from` to `to` in all items of an iterable.
-
-    The call to "map" could be taken out of the fuction, but it would get
-    a bit too verbose for my liking.
-    """
+    """Replace all of `_from` to `to` in all items of a column."""
 
-    def wrapped(data: Iterable):
-        return lmap(lambda x: x.replace(_from, to), data)
+    def wrapped(data: pd.Series):
+        return data.str.replace(_from, to, regex=False)
 
     return wrapped
 
 
 def follow_map(map: dict, default: Optional[str] = None) -> Callable:
-    """Replace all instances in an iterable with new stuff
+    """Replace all instances in a column with new stuff
 
     Takes a hashmap with as keys the strings to replace and as values the
     strings to replace to, as in {'old': 'new'}.
     """
 
-    def wrapped(data: Iterable):
-        def try_convert(x):
-            try:
-                return map[x]
-            except KeyError as e:
-                if default:
-                    return default
-                raise e
-
-        return lmap(try_convert, data)
+    def wrapped(data: pd.Series):
+        converted = data.map(map)
+        missing = ~data.isin(list(map.keys()))
+        if missing.any():
+            if not default:
+                raise KeyError(data[missing].iloc[0])
+            converted[missing] = default
+        return converted
 
     return wrapped
 
 
+def combine_regexes(patterns: Iterable[str]) -> re.Pattern:
+    """Combine many regexes in one, that tells which one matched first
+
+    The n-th pattern that can be found in the string (in the order they are
+    given, not by position in the string) sets the group `_n` of the match.
+    """
+    alternatives = [
+        rf"(?=[\s\S]*?(?:{pattern}))(?P<_{i}>)" for i, pattern in enumerate(patterns)
+    ]
+    return re.compile("^(?:" + "|".join(alternatives) + ")")
+
+
 def follow_regmap(map: dict, default: Optional[str] = None) -> Callable:
-    """Replace all instances that match a regex in an iterable with new stuff
+    """Replace all instances that match a regex in a column with new stuff
 
     Like `follow_map`, but taking regex expressions as keys and replacing if
     any of them, in order, find a match.
-    """
 
-    def wrapped(data: Iterable):
-        def try_convert(x):
-            for key in map.keys():
-                if re.search(key, x):
-                    return map[key]
-            raise ValueError(f"No regex key matches pattern: {x}")
-
-        return lmap(try_convert, data)
+    All regexes are combined in one, and only run once on every distinct
+    value of the column.
+    """
+    matcher = combine_regexes(map.keys())
+    replacements = list(map.values())
+
+    def wrapped(data: pd.Series):
+        values = pd.Series(data.unique())
+        groups = values.str.extract(matcher)
+        found = groups.notna()
+        if not found.any(axis=1).all():
+            raise ValueError(
+                f"No regex key matches pattern: {values[~found.any(axis=1)].iloc[0]}"
+            )
+        # The first (and only) group that matched tells us the replacement
+        first = found.to_numpy().argmax(axis=1)
+        lookup = dict(zip(values, (replacements[i] for i in first)))
+        return data.map(lookup)
 
     return wrapped
 
@@ -246,12 +257,30 @@ OPERATIONS: dict[str, Callable] = {
 }
 
 
-def main(metadata: Path, accession: str):
+def fix_metadata(metadata: Path, accession: str) -> pd.DataFrame:
     data = pd.read_csv(metadata)
-    result = OPERATIONS[accession](data)
+    return OPERATIONS[accession](data)
+
+
+def main(metadata: Path, accession: str):
+    result = fix_metadata(metadata, accession)
     result.to_csv(sys.stdout, index=False)
 
 
+def batch_main(metadata: list[Path], output_dir: Path):
+    """Fix many metadata files, named after their accession IDs
+
+    The results are saved as <accession>.meta.csv in the output dir.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for path in metadata:
+        accession = stem_of(path)
+        eprint(f"Fixing {accession}")
+        fix_metadata(path, accession).to_csv(
+            output_dir / f"{accession}.meta.csv", index=False
+        )
+
+
 def stem_of(path: Path) -> str:
     while path.suffixes:
         path = Path(path.stem)
@@ -263,15 +292,26 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("metadata", type=Path)
+    parser.add_argument("metadata", type=Path, nargs="+")
     parser.add_argument(
         "--id",
         type=str,
         help="Accession ID. If not specified, uses the name of the metadata file.",
     )
+    parser.add_argument(
+        "--output-dir",
+        type=Path,
+        help="Fix all the metadata files, saving them as <accession>.meta.csv in this folder. Accessions are taken from the file names.",
+    )
 
     args = parser.parse_args()
 
-    main(
-        metadata=args.metadata, accession=args.id if args.id else stem_of(args.metadata)
-    )
+    if args.output_dir:
+        batch_main(args.metadata, args.output_dir)
+    else:
+        if len(args.metadata) > 1:
+            parser.error("Specify an --output-dir to fix more than one metadata file")
+        main(
+            metadata=args.metadata[0],
+            accession=args.id if args.id else stem_of(args.metadata[0]),
+        )
@@ -2,11 +2,17 @@ import sys
 
 BASE_URL = "https://ftp.ncbi.nlm.nih.gov/geo/series/{}nnn/{}/matrix/{}_series_matrix.txt.gz"
 
+import hashlib
+import json
+import os
 import shutil
+import tempfile
+import urllib.error
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
-import io
 from gzip import GzipFile
+from pathlib import Path
 
 # Everything is an exception. Some series have many matrix files.
 # This fixes these ambiguities.
@@ -16,30 +22,123 @@ EXCEPTIONS = {
     "GSE121842": "GSE121842-GPL20795"
 }
 
+# Size of the chunks that are streamed from the network to the disk
+CHUNK_SIZE = 2**20
+
 def eprint(*args, **kwargs):
     print(*args, **kwargs, file = sys.stderr)
 
-def fetch_ftp(url):
+def series_url(accession, base_url = BASE_URL):
+    truncated = accession[:-3]
+    matrix_accession = accession if accession not in EXCEPTIONS else EXCEPTIONS[accession]
+    return base_url.format(truncated, accession, matrix_accession)
+
+
+class SeriesCache:
+    """A local copy of the (compressed) downloaded series
+
+    Each entry is keyed by the hash of its URL, and holds the ETag that the
+    server gave us for it, so that it can be revalidated.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents = True, exist_ok = True)
+
+    def _key(self, url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def data_path(self, url):
+        return self.path / f"{self._key(url)}.gz"
+
+    def etag(self, url):
+        """Get the ETag of a cached URL, or None if it is not cached"""
+        info = self.path / f"{self._key(url)}.json"
+        if not info.exists() or not self.data_path(url).exists():
+            return None
+        with info.open("r") as stream:
+            return json.load(stream)["etag"]
+
+    def store(self, url, response):
+        """Save the body of a response to the cache, streaming it"""
+        handle, tmp_path = tempfile.mkstemp(dir = self.path)
+        try:
+            with os.fdopen(handle, "wb") as stream:
+                shutil.copyfileobj(response, stream, CHUNK_SIZE)
+            os.replace(tmp_path, self.data_path(url))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with (self.path / f"{self._key(url)}.json").open("w") as stream:
+            # Servers that send no ETag still get an entry, that is just
+            # never revalidated successfully
+            json.dump({"url": url, "etag": response.headers.get("ETag") or ""}, stream)
+
+
+def fetch_ftp(url, output_stream, cache = None, revalidate = False):
+    """Download a gzipped file, writing it decompressed to the output
+
+    The data is decompressed as it arrives, so it is never all in memory.
+    If there is a cache, the file is only downloaded if it is not in the
+    cache already (or if its ETag changed, if `revalidate` is set).
+    """
+    if cache is not None:
+        etag = cache.etag(url)
+        if etag is not None and not revalidate:
+            eprint(f"Using cached {url}")
+            with GzipFile(cache.data_path(url), "rb") as stream:
+                shutil.copyfileobj(stream, output_stream, CHUNK_SIZE)
+            return
+
+        request = urllib.request.Request(url)
+        if etag:
+            request.add_header("If-None-Match", etag)
+
+        eprint(f"Fetching {url}...")
+        try:
+            with closing(urllib.request.urlopen(request)) as r:
+                cache.store(url, r)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            eprint(f"Cached {url} is still valid")
+
+        with GzipFile(cache.data_path(url), "rb") as stream:
+            shutil.copyfileobj(stream, output_stream, CHUNK_SIZE)
+        return
+
     eprint(f"Fetching {url}...")
-    stream = io.BytesIO()
     with closing(urllib.request.urlopen(url)) as r:
-        shutil.copyfileobj(r, stream)
-
-    stream.seek(0)
-    return GzipFile(fileobj=stream).read()
+        with GzipFile(fileobj = r) as stream:
+            shutil.copyfileobj(stream, output_stream, CHUNK_SIZE)
+
+def fetch_to_file(accession, output_dir, base_url, cache, revalidate):
+    target = output_dir / f"{accession}_series_matrix.txt"
+    # Only move the file in place once it is complete
+    tmp_target = target.with_name(target.name + ".part")
+    with tmp_target.open("wb") as stream:
+        fetch_ftp(series_url(accession, base_url), stream, cache, revalidate)
+    os.replace(tmp_target, target)
+    return target
 
 def main(output_stream, args):
-    truncated = args.accession[:-3]
-    accession = args.accession if args.accession not in EXCEPTIONS else  EXCEPTIONS[args.accession]
-    url = BASE_URL.format(
-        truncated,
-        args.accession,
-        accession
-    )
+    cache = SeriesCache(args.cache_dir) if args.cache_dir else None
 
-    data = fetch_ftp(url)
+    if args.output_dir is None:
+        if len(args.accession) > 1:
+            raise ValueError("Specify an --output-dir to download more than one series")
+        url = series_url(args.accession[0], args.base_url)
+        fetch_ftp(url, output_stream, cache, args.revalidate)
+        return
 
-    output_stream.writelines(data.decode("utf-8"))
+    args.output_dir.mkdir(parents = True, exist_ok = True)
+    with ThreadPoolExecutor(args.jobs) as pool:
+        futures = [
+            pool.submit(fetch_to_file, accession, args.output_dir, args.base_url, cache, args.revalidate)
+            for accession in args.accession
+        ]
+        for future in futures:
+            eprint(f"Saved {future.result()}")
 
 
 if __name__ == "__main__":
@@ -47,10 +146,26 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("accession", help="Accession ID of series to download")
+    parser.add_argument("accession", help="Accession ID(s) of series to download", nargs = "+")
+    parser.add_argument(
+        "--output-dir",
+        type = Path,
+        help = "Save the series as <accession>_series_matrix.txt in this folder. If unspecified, writes the (single) series to stdout."
+    )
+    parser.add_argument("--jobs", type = int, default = 4, help = "Number of series to download at once")
+    parser.add_argument("--cache-dir", type = Path, help = "Keep the downloaded series in this folder, and reuse them")
+    parser.add_argument(
+        "--revalidate",
+        action = "store_true",
+        help = "Check with the server if the cached series changed (by ETag) before using them"
+    )
+    parser.add_argument(
+        "--base-url",
+        default = BASE_URL,
+        help = "Template of the URL to download from, with three {} for the truncated accession, the accession and the matrix accession"
+    )
 
     args = parser.parse_args()
-    output_stream = sys.stdout
+    output_stream = sys.stdout.buffer
 
     main(output_stream, args)
-
@@ -1,29 +1,53 @@
-"""Retrieve a series file and take out specific columns from it"""
+"""Retrieve a series file and take out specific columns from it
+
+The series matrix is read lazily, line by line, and only up to the start of
+the expression table, since all the metadata is in the header. The input
+can be gzipped.
+"""
 import sys
 import csv
+import io
+import gzip
+from pathlib import Path
+from typing import Iterable, Optional
+
+TABLE_MARKER = "!series_matrix_table_begin"
 
-def series_to_dict(text: str, strip_prefix: bool = True):
+def series_to_dict(lines: Iterable[str], strip_prefix: bool = True, keep: Optional[set] = None):
+    """Parse the metadata lines of a series matrix
+
+    Stops at the start of the expression table. If `keep` is given, only
+    the keys in it are parsed and returned.
+    """
     keys = {}
     prefix = "!Series_" if strip_prefix else "!"
-    for line in text.split("\n"):
+    for line in lines:
         if not line.startswith("!"):
             continue
+        if line.startswith(TABLE_MARKER):
+            break
         line = line.strip()
         line = line[len(prefix):]
-        pieces = line.split("\t")
-        if len(pieces) < 2:
+        id, sep, rest = line.partition("\t")
+        if not sep or (keep is not None and id not in keep):
             continue
-        id = pieces[0]
-        pieces = pieces[1:] if len(pieces) > 2 else pieces[1]
-        keys[id] = [x.strip('"') for x in pieces]
+        keys[id] = [x.strip('"') for x in rest.split("\t")]
 
     return keys
 
 
+def open_series(binary_stream) -> io.TextIOWrapper:
+    """Open a (possibly gzipped) binary stream as text"""
+    buffered = io.BufferedReader(binary_stream) if not hasattr(binary_stream, "peek") else binary_stream
+    if buffered.peek(2)[:2] == b"\x1f\x8b":
+        buffered = gzip.GzipFile(fileobj=buffered)
+    return io.TextIOWrapper(buffered, encoding="utf-8")
+
+
 def main(input_stream, output_stream, args):
-    file = input_stream.read()
-    data = series_to_dict(file, not args.keep_sample_prefix)
-    
+    wanted = {args.id_col, *args.meta_cols}
+    data = series_to_dict(open_series(input_stream), not args.keep_sample_prefix, wanted)
+
     if args.id_col not in data:
         raise ValueError(f"ID col {args.id_col} not in input file")
 
@@ -36,7 +60,7 @@ def main(input_stream, output_stream, args):
             raise ValueError(f"Meta col {col} has bad length: expected {len(id)}, got {len(data[col])}")
 
         metadata_cols.append([f"var_{i}"] + data[col])
-    
+
     # Join together the values
     id = ["sample_id"] + id
 
@@ -53,12 +77,18 @@ if __name__ == "__main__":
 
     parser.add_argument("id_col", help="Name of column with the sample IDs")
     parser.add_argument("--keep-sample-prefix", help="Keep the 'Sample_' prefix?")
+    parser.add_argument(
+        "--input",
+        type=Path,
+        help="Series matrix to read (possibly gzipped). If unspecified, reads from stdin.",
+    )
     parser.add_argument("meta_cols", help="Column(s) to extract", nargs="+")
 
     args = parser.parse_args()
 
-    input_stream = sys.stdin
+    input_stream = args.input.open("rb") if args.input else sys.stdin.buffer
     output_stream = sys.stdout
 
-    main(input_stream= input_stream, output_stream=output_stream, args = args)
+    with input_stream:
+        main(input_stream= input_stream, output_stream=output_stream, args = args)
 
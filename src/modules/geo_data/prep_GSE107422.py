@@ -1,59 +1,75 @@
 from pathlib import Path
 import gzip
+import io
 import tarfile
-from io import BytesIO, StringIO
+from collections import deque
+import multiprocessing as mp
 import pandas as pd
 import sys
 import re
-from copy import copy
-from tqdm import tqdm
-from functools import reduce
+
+# Each id is of format `gi|...|ref|<refseq_id>.<version>|`. We need the refseq ID
+REFSEQ_ID = re.compile(r"^gi\|[0-9]+?\|ref\|(N[M|R]_[0-9]+?)\.[0-9]+\|")
 
 def eprint(*args, **kwargs):
     print(*args, **kwargs, file=sys.stderr)
 
-def extract_refseq_id(original: str) -> str:
-    matcher = re.compile(r"gi\|[0-9]+?\|ref\|(N[M|R]_[0-9]+?)\.[0-9]+\|")
-    res = matcher.match(original)
-    
-    return res.group(1)
+def extract_refseq_ids(ids: pd.Series) -> pd.Series:
+    extracted = ids.str.extract(REFSEQ_ID, expand=False)
+    if extracted.isna().any():
+        raise ValueError(f"Cannot find a RefSeq ID in {ids[extracted.isna()].iloc[0]}")
+    return extracted
 
-def main(args):
-    
-    files = {}
-    with tarfile.open(args.raw, "r") as conn:
-        members = conn.getmembers()
-        for member in members:
-            if not member.isfile():
-                continue
-            
-            files[member.name] = BytesIO(conn.extractfile(member).read())
+def parse_member(item):
+    """Decompress and parse one sample file, indexing it by RefSeq ID
 
-    eprint(f"Read {len(files)} files. Decompressing")
-    
-    data = []
-    for k, v in files.items():
-        eprint(f"Decompressing {k}")
-        conn = gzip.decompress(v.read())
-        data.append(pd.read_csv(StringIO(conn.decode("utf-8")), sep = "\t"))
+    The concat in `main` needs unique IDs, so only the first row of IDs
+    that are repeated in a sample is kept.
+    """
+    name, compressed = item
+    with gzip.GzipFile(fileobj=io.BytesIO(compressed)) as stream:
+        frame = pd.read_csv(stream, sep="\t")
+    frame["unique_id"] = extract_refseq_ids(frame["unique_id"])
+    duplicated = frame["unique_id"].duplicated(keep="first")
+    if duplicated.any():
+        eprint(f"Dropping {duplicated.sum()} rows with repeated IDs from {name}")
+        frame = frame[~duplicated]
+    return name, frame.set_index("unique_id")
 
-    eprint("Finished loading csvs. Parsing IDs")
-    # Each id is of format `gi|...|ref|<refseq_id>|`. We need the refseq ID
-    def rename_ids(x):
-        y = copy(x)
-        y["unique_id"] = list(map(extract_refseq_id, x["unique_id"]))
+def iter_members(path: Path):
+    """Yield the name and (compressed) content of all the files in a tarball"""
+    # Streaming mode: the members are read in order, one at a time
+    with tarfile.open(path, "r|*") as conn:
+        for member in conn:
+            if not member.isfile():
+                continue
+            yield member.name, conn.extractfile(member).read()
 
-        return y
+def main(args):
+    frames = []
+    with mp.Pool(args.cpus or mp.cpu_count()) as pool:
+        # Only keep a few members in flight, so that we never hold much more
+        # than what the workers are processing
+        pending = deque()
+        max_pending = 2 * (args.cpus or mp.cpu_count())
+        for item in iter_members(args.raw):
+            pending.append(pool.apply_async(parse_member, (item,)))
+            if len(pending) >= max_pending:
+                name, frame = pending.popleft().get()
+                eprint(f"Parsed {name}")
+                frames.append(frame)
+        while pending:
+            name, frame = pending.popleft().get()
+            eprint(f"Parsed {name}")
+            frames.append(frame)
 
-    data = list(map(rename_ids, tqdm(data)))
-    
-    eprint("Merging...")
-    merged = reduce(lambda x, y: pd.merge(x, y, on="unique_id", how="outer"), tqdm(data))
+    # The merged rows are sorted, so nothing can be written before all the
+    # samples are in: memory use is that of the whole merged matrix
+    eprint(f"Read {len(frames)} files. Merging...")
+    merged = pd.concat(frames, axis=1, join="outer").sort_index()
+    merged.index.name = "unique_id"
 
-    out = StringIO()
-    merged.to_csv(out, index=False)
-    out.seek(0)
-    print(out.read())
+    merged.to_csv(sys.stdout)
 
 
 if __name__ == "__main__":
@@ -62,6 +78,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument("raw", help="Path to raw compressed data", type = Path)
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        help="Number of files to parse in parallel. If unspecified, uses all available cores.",
+    )
 
     args = parser.parse_args()
 
@@ -0,0 +1,192 @@
+"""Rank the genes of all the GEO datasets, in one go
+
+For every dataset this:
+    - splits the counts into case and control samples, following the `status`
+      column of the fixed metadata (made by `fix_geo_metadata.py`);
+    - log-transforms the counts, as log2(x + 1);
+    - ranks the genes with `generanker`.
+
+Everything but the ranking is done in memory. The series are processed in
+parallel, each loading its files once for all of its datasets.
+
+Datasets are named like the GEO series they come from. Datasets with a
+suffix, like `GSE159857_LUAD`, only take the samples of the series with
+that `type` in the fixed metadata.
+"""
+
+import functools as ft
+import multiprocessing as mp
+import sys
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+from subprocess import run
+
+import numpy as np
+import pandas as pd
+
+from gene_ranker.methods import RANKING_METHODS
+
+# The shared readers live in the parent folder
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from matrix_io import read_matrix, write_matrix
+
+
+def eprint(*args, **kwargs):
+    print(*args, **kwargs, file=sys.stderr)
+
+
+def find_file(input_dir: Path, name: str) -> Path:
+    """Find a file in the input dir, that may or may not be gzipped"""
+    for candidate in (input_dir / name, input_dir / f"{name}.gz"):
+        if candidate.exists():
+            return candidate
+    raise FileNotFoundError(f"Cannot find {name} (or {name}.gz) in {input_dir}")
+
+
+def load_series(
+    input_dir: Path, metadata_dir: Path, accession: str
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    eprint(f"Loading {accession}...")
+    metadata = pd.read_csv(find_file(metadata_dir, f"{accession}.meta.csv"))
+    counts = read_matrix(find_file(input_dir, f"{accession}.counts.csv"))
+    return metadata, counts
+
+
+def log_transform(frame: pd.DataFrame) -> pd.DataFrame:
+    """Apply log2(x + 1) to all the numeric columns of a frame"""
+    numeric = frame.select_dtypes("number").columns
+    values = frame[numeric].to_numpy(dtype="float64", copy=True)
+    values += 1
+    np.log2(values, out=values)
+    result = frame.copy()
+    result[numeric] = values
+    return result
+
+
+def rank(case: pd.DataFrame, control: pd.DataFrame, target: Path, method: str, id_col: str):
+    """Rank genes with `generanker`, saving the ranking to `target`"""
+    with tempfile.TemporaryDirectory() as scratch:
+        case_path = Path(scratch) / "case.csv"
+        control_path = Path(scratch) / "control.csv"
+        write_matrix(case, case_path)
+        write_matrix(control, control_path)
+
+        args = [
+            "generanker",
+            "--output-file",
+            target,
+            "--id-col",
+            id_col,
+            case_path,
+            control_path,
+            method,
+        ]
+        args = [str(x) for x in args]
+        eprint(f"Executing: {' '.join(args)}")
+        run(args, check=True)
+
+
+def rank_dataset(
+    dataset: str,
+    metadata: pd.DataFrame,
+    counts: pd.DataFrame,
+    output_dir: Path,
+    method: str,
+    id_col: str,
+):
+    subset = dataset.partition("_")[2]
+    if subset:
+        metadata = metadata[metadata["type"] == subset]
+
+    split = {}
+    for status in ("case", "control"):
+        samples = set(metadata.loc[metadata["status"] == status, "ena_run"])
+        columns = [x for x in counts.columns if x in samples]
+        if not columns:
+            raise ValueError(f"No {status} samples found for {dataset}")
+        eprint(f"{dataset}: {len(columns)} {status} samples")
+        split[status] = log_transform(counts[[id_col] + columns])
+
+    rank(
+        split["case"],
+        split["control"],
+        output_dir / f"{dataset}.dea.csv",
+        method,
+        id_col,
+    )
+
+
+def rank_series(
+    item: tuple[str, list[str]],
+    input_dir: Path,
+    metadata_dir: Path,
+    output_dir: Path,
+    method: str,
+    id_col: str,
+) -> list[str]:
+    """Rank all the datasets of a series, loading its files only once"""
+    accession, datasets = item
+    metadata, counts = load_series(input_dir, metadata_dir, accession)
+    for dataset in datasets:
+        rank_dataset(dataset, metadata, counts, output_dir, method, id_col)
+    return datasets
+
+
+def main(args):
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    # Each task is a series, with all of its datasets
+    series = defaultdict(list)
+    for dataset in args.datasets:
+        series[dataset.partition("_")[0]].append(dataset)
+
+    run = ft.partial(
+        rank_series,
+        input_dir=args.input_dir,
+        metadata_dir=args.metadata_dir,
+        output_dir=args.output_dir,
+        method=args.method,
+        id_col=args.id_col,
+    )
+    with mp.Pool(args.cpus or mp.cpu_count()) as pool:
+        for datasets in pool.imap_unordered(run, series.items()):
+            eprint(f"Ranked {', '.join(datasets)}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "input_dir",
+        type=Path,
+        help="Directory with the (possibly gzipped) <series>.counts.csv files",
+    )
+    parser.add_argument(
+        "metadata_dir",
+        type=Path,
+        help="Directory with the fixed <series>.meta.csv files, from fix_geo_metadata.py",
+    )
+    parser.add_argument(
+        "output_dir", type=Path, help="Directory to save the <dataset>.dea.csv files in"
+    )
+    parser.add_argument("datasets", nargs="+", help="Datasets to rank")
+    parser.add_argument(
+        "--method",
+        type=str,
+        help="Method to use for generanker",
+        choices=RANKING_METHODS.keys(),
+        default="norm_fold_change",
+    )
+    parser.add_argument("--id-col", default="gene_id", help="Column with the gene IDs")
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        help="Number of CPUS to use. If unspecified, runs with one process per available core.",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import argparse
+import hashlib
+import io
 import json
 import logging
+import pickle
 import random
 from collections import Counter
-from copy import copy
 from enum import Enum
 from logging import StreamHandler
 from pathlib import Path
 from sqlite3 import Connection, connect
+from typing import Any, Iterable, Optional
 
 import numpy
 import pandas as pd
@@ -17,8 +21,12 @@ from bonsai import Node, Tree, IdBuilder
 from colorama import Back, Fore, Style
 from tqdm import tqdm
 
-random.seed(1)
-numpy.random.seed(1)
+from geneset_store import write_gmt, write_store
+
+# Seed of the random generators, also used to reset them between in-process runs
+SEED = 1
+random.seed(SEED)
+numpy.random.seed(SEED)
 
 builder = IdBuilder()
 
@@ -60,30 +68,254 @@ log.addHandler(stream_h)
 ## <<<< Logging setup
 
 
+# Bump this whenever the structure (or the making) of the cached objects
+# changes, so that stale caches are ignored instead of being loaded.
+CACHE_VERSION = 3
+
+
+def file_checksum(path: Path, chunk_size: int = 2**20) -> str:
+    """Compute the SHA256 checksum of a file, reading it in chunks"""
+    digest = hashlib.sha256()
+    with path.open("rb") as stream:
+        while chunk := stream.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(*parts: Any) -> str:
+    """Make a stable hash out of a series of JSON-serializable objects"""
+    blob = json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class GenesetCache:
+    """On-disk cache for the intermediate products of `main`
+
+    There are three layers, each keyed on everything that can change its
+    contents:
+        - "tables": the large tables loaded from the database, keyed on the
+          database checksum and the genesets/queries of the gene lists;
+        - "trees": the unpruned, per-table gene trees, keyed on the tables
+          key and the parameters of `generate_gene_list_trees`;
+        - "pruned": the final JSON and representation of the pasted and
+          pruned tree, keyed on the trees key, the structure and the pruning
+          parameters.
+
+    Changing just the pruning parameters therefore reuses the (slow) tree
+    generation step. If `cache_dir` is None, the cache is disabled and
+    every lookup misses.
+    """
+
+    def __init__(self, cache_dir: Optional[Path]) -> None:
+        self.cache_dir = cache_dir
+
+    def _path_of(self, layer: str, key: str) -> Path:
+        return self.cache_dir / layer / f"{key}.pkl"
+
+    def get(self, layer: str, key: str) -> Optional[Any]:
+        if self.cache_dir is None:
+            return None
+        path = self._path_of(layer, key)
+        if not path.exists():
+            log.debug(f"Cache miss for {layer}/{key}")
+            return None
+        log.info(f"Cache hit for {layer}/{key}")
+        try:
+            with path.open("rb") as stream:
+                return pickle.load(stream)
+        except Exception as e:
+            log.warning(f"Could not load cached {layer}/{key} ({e}). Ignoring it.")
+            return None
+
+    def put(self, layer: str, key: str, value: Any) -> None:
+        if self.cache_dir is None:
+            return
+        path = self._path_of(layer, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so that an interrupted run never
+        # leaves behind a truncated cache entry
+        temp = path.with_suffix(".tmp")
+        try:
+            with temp.open("wb") as stream:
+                pickle.dump(value, stream, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            log.warning(f"Could not cache {layer}/{key} ({e}). Skipping.")
+            temp.unlink(missing_ok=True)
+            return
+        temp.replace(path)
+        log.debug(f"Cached {layer}/{key}")
+
+
+class GeneUniverse:
+    """Interns gene IDs to dense integers, so that genesets can be bitsets
+
+    The IDs are sorted, and each one is given its position as code. A geneset
+    is then a Python integer where bit `i` is set if the gene with code `i`
+    is in the set. This takes a few hundred bytes for the whole transportome,
+    and comparing two sets is just an `&` and a `bit_count`.
+    """
+
+    def __init__(self, ids: Iterable[str]) -> None:
+        self.ids: list[str] = sorted(set(ids))
+        self.codes: dict[str, int] = {x: i for i, x in enumerate(self.ids)}
+        self.n_bytes = (len(self.ids) + 7) // 8
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def encode(self, ids: Iterable[str]) -> numpy.ndarray:
+        """Convert gene IDs to their (int32) codes, with -1 for missing IDs"""
+        return numpy.fromiter(
+            (-1 if pd.isna(x) else self.codes[x] for x in ids), dtype=numpy.int32
+        )
+
+    def to_bitset(self, codes: numpy.ndarray) -> int:
+        """Convert an array of codes to a bitset, ignoring missing IDs (-1)"""
+        bits = numpy.zeros(len(self.ids), dtype=bool)
+        bits[codes[codes >= 0]] = True
+        return int.from_bytes(
+            numpy.packbits(bits, bitorder="little").tobytes(), "little"
+        )
+
+    def decode(self, bitset: int) -> list[str]:
+        """Convert a bitset back to a (sorted) list of gene IDs"""
+        packed = numpy.frombuffer(bitset.to_bytes(self.n_bytes, "little"), numpy.uint8)
+        bits = numpy.unpackbits(packed, bitorder="little")[: len(self.ids)]
+        return [self.ids[i] for i in numpy.flatnonzero(bits)]
+
+
 class PruneDirection(Enum):
     TOPDOWN = "topdown"
     BOTTOMUP = "bottomup"
 
 
-def calc_similarity(node_a: set, node_b: set) -> float:
-    # For compatibility
-    node_a = set(node_a)
-    node_b = set(node_b)
-
+def calc_similarity(node_a: int, node_b: int) -> float:
+    # The nodes are bitsets made by a `GeneUniverse`.
     # This is the Sorens-Dice coefficient. It was chosen because it is very easy to compute
     # and it's really similar to the Jaccard index anyway.
     # It empirically worked pretty well.
-    return 2 * (len(node_a.intersection(node_b)) / (len(node_a) + len(node_b)))
+    return 2 * ((node_a & node_b).bit_count() / (node_a.bit_count() + node_b.bit_count()))
+
+
+class IndexedTree:
+    """Index around a bonsai `Tree`, kept up to date as the tree changes
 
+    Bonsai looks up nodes by name, their depth and the leaves of the tree by
+    walking over all of its nodes every time. This keeps name -> ids,
+    id -> depth and id -> number of children maps, plus the set of leaves,
+    and updates them incrementally as nodes are added or pruned.
 
-def prune(tree: Tree, similarity: float, direction: PruneDirection) -> Tree:
-    original_len = len(tree.nodes)
+    All changes to the tree must go through this class, or the index will
+    become stale.
+    """
+
+    def __init__(self, tree: Tree) -> None:
+        self.tree = tree
+        self.ids_by_name: dict[str, list[str]] = {}
+        self.depth: dict[str, int] = {}
+        self.n_children: dict[str, int] = {}
+        # Position of each node in the tree, to keep the same order of
+        # nodes that bonsai would have
+        self.order: dict[str, int] = {}
+        self.leaves: set[str] = set()
+        # Nodes that became leaves after a node was pruned, in the order
+        # in which it happened
+        self.new_leaves: list[str] = []
+
+        self._index_new_nodes()
+
+    def __len__(self) -> int:
+        return len(self.tree.nodes)
+
+    def __str__(self) -> str:
+        return str(self.tree)
+
+    def _index_new_nodes(self) -> None:
+        new_ids = [x for x in self.tree.nodes if x not in self.order]
+
+        for node_id in new_ids:
+            node = self.tree.nodes[node_id]
+            self.order[node_id] = len(self.order)
+            self.ids_by_name.setdefault(node.name, []).append(node_id)
+            self.n_children.setdefault(node_id, 0)
+            self.leaves.add(node_id)
+
+        for node_id in new_ids:
+            parent = self.tree.nodes[node_id].parent
+            if parent is None:
+                continue
+            self.n_children[parent] = self.n_children.get(parent, 0) + 1
+            self.leaves.discard(parent)
+
+        for node_id in new_ids:
+            self._depth_of(node_id)
+
+    def _depth_of(self, node_id: str) -> int:
+        # Walk up until we hit a node of known depth, then fill the path
+        path = []
+        while node_id not in self.depth:
+            parent = self.tree.nodes[node_id].parent
+            if parent is None:
+                self.depth[node_id] = 0
+                break
+            path.append(node_id)
+            node_id = parent
+
+        depth = self.depth[node_id]
+        for item in reversed(path):
+            depth += 1
+            self.depth[item] = depth
+
+        return depth
+
+    def create_node(self, name: str, parent: Optional[str], **kwargs) -> str:
+        node_id = self.tree.create_node(name, parent, **kwargs)
+        self._index_new_nodes()
+        return node_id
+
+    def paste(self, other: Tree, node_id: str, **kwargs) -> None:
+        self.tree.paste(other, node_id, **kwargs)
+        self._index_new_nodes()
+
+    def get_one_node_named(self, name: str) -> Node:
+        ids = self.ids_by_name.get(name, [])
+        if len(ids) != 1:
+            raise ValueError(f"Expected one node named {name}, found {len(ids)}")
+        return self.tree.nodes[ids[0]]
+
+    def prune_leaf(self, node_id: str) -> None:
+        """Prune a leaf from the tree, updating the index"""
+        assert node_id in self.leaves, f"Node {node_id} is not a leaf"
+        parent = self.tree.nodes[node_id].parent
+        name = self.tree.nodes[node_id].name
+
+        self.tree.prune(node_id)
+
+        self.ids_by_name[name].remove(node_id)
+        if not self.ids_by_name[name]:
+            del self.ids_by_name[name]
+        del self.depth[node_id]
+        del self.n_children[node_id]
+        del self.order[node_id]
+        self.leaves.remove(node_id)
+
+        if parent is not None:
+            self.n_children[parent] -= 1
+            if self.n_children[parent] == 0:
+                self.leaves.add(parent)
+                self.new_leaves.append(parent)
+
+
+def prune(tree: IndexedTree, similarity: float, direction: PruneDirection) -> IndexedTree:
+    original_len = len(tree)
     log.info(f"Pruning {tree}.")
 
     reverse_sort = direction == PruneDirection.TOPDOWN
 
-    def is_similar(node: Node, nodes: list[Node]) -> bool:
-        for other in nodes:
+    def is_similar(node: Node) -> bool:
+        for other in tree.tree.nodes.values():
+            if other.id == node.id:
+                continue
             # This is reversed.
             # If the other node is the root, ignore it.
             if any([other.id == "0", node.id == "0"]):
@@ -96,32 +328,38 @@ def prune(tree: Tree, similarity: float, direction: PruneDirection) -> Tree:
             return True
         return False
 
+    # Pruning only ever removes nodes, so a leaf that was not similar to any
+    # node in one cycle can never become similar later on.
+    # We only need to check the leaves that appeared since the last cycle.
+    candidates = list(tree.leaves)
+    tree.new_leaves = []
+
     cycle = 0
     pruned = True
     while pruned:
         pruned = False
-        log.info(f"Prune cycle {cycle} -- {len(tree.nodes)} nodes in tree.")
-        # Find all leaves
-        leaves = tree.leaves()
-
-        # Sort them
-        leaves.sort(
-            key=lambda x: tree.depth_of(x.id),
-            reverse=reverse_sort,
+        log.info(f"Prune cycle {cycle} -- {len(tree)} nodes in tree.")
+        # Sort the candidate leaves, first in tree order, then by depth
+        # (the sort is stable, so the tree order is kept for ties).
+        leaves = sorted(
+            (x for x in candidates if x in tree.leaves),
+            key=lambda x: tree.order[x],
         )
+        leaves.sort(key=lambda x: tree.depth[x], reverse=reverse_sort)
 
         # Prune
-        for node in tqdm(leaves):
-            other_nodes = list(copy(list(tree.nodes.values())))
-            other_nodes.remove(node)
-            if is_similar(node, other_nodes):
+        for node_id in tqdm(leaves):
+            node = tree.tree.nodes[node_id]
+            if is_similar(node):
                 log.debug(f"Pruned {node}")
                 pruned = True
-                tree.prune(node.id)
+                tree.prune_leaf(node_id)
 
+        candidates = tree.new_leaves
+        tree.new_leaves = []
         cycle += 1
 
-    len_diff = original_len - len(tree.nodes)
+    len_diff = original_len - len(tree)
     log.info(
         f"Prune finished. Removed {len_diff} nodes ({round(len_diff / original_len * 100, 3)}% of total)"
     )
@@ -129,39 +367,119 @@ def prune(tree: Tree, similarity: float, direction: PruneDirection) -> Tree:
     return tree
 
 
-def main(args: dict) -> None:
-    log.info(f"Launching with args: {args}")
+def make_genesets(args: argparse.Namespace) -> tuple[str, str]:
+    """Make the genesets, returning the node JSON and tree representation
 
-    log.info(f"Connecting to {args.database_path}...")
-    connection: Connection = connect(args.database_path)
+    This does not write anything (except to the cache), so that it can be
+    called in-process, e.g. by `helper_scripts/test_ariadne_consistency.py`.
+    """
+    cache = GenesetCache(args.cache_dir)
 
-    # 1. Generate large tables
-    log.info("Making large tables...")
     with args.basic_gene_lists.open("r") as stream:
         sets = json.load(stream)
 
-    large_tables = make_large_tables(connection, sets)
-
-    log.info(f"Made {len(large_tables)} large tables.")
-
-    # 2. Generate lists from large tables
-    log.info("Generating gene trees...")
-    trees = {}
-    for name, table in large_tables.items():
-        log.info(f"Processing table {name}")
-        tree = generate_gene_list_trees(
-            table,
-            name,
-            min_pop_score=args.min_pop_score,
-            min_set_size=args.min_set_size,
-            min_recurse_set_size=args.min_recurse_set_size,
-            recurse=not args.no_recurse,
+    log.info(f"Fingerprinting {args.database_path}...")
+    tables_key = fingerprint(
+        file_checksum(args.database_path),
+        sets.get("genesets", None),
+        sets.get("queries", None),
+    )
+    trees_key = fingerprint(
+        tables_key,
+        args.min_pop_score,
+        args.min_set_size,
+        args.min_recurse_set_size,
+        args.no_recurse,
+    )
+    pruned_key = fingerprint(
+        trees_key,
+        sets["structure"],
+        args.no_prune,
+        args.prune_similarity,
+        args.prune_direction,
+    )
+
+    outputs = cache.get("pruned", pruned_key)
+    if outputs is None:
+        outputs = build_outputs(args, sets, cache, tables_key, trees_key)
+        cache.put("pruned", pruned_key, outputs)
+
+    return outputs
+
+
+def main(args: argparse.Namespace) -> None:
+    log.info(f"Launching with args: {args}")
+
+    node_json, representation = make_genesets(args)
+
+    with Path(args.out_json).open("w+") as stream:
+        stream.write(node_json)
+    with Path(args.out_repr).open("w+") as stream:
+        stream.write(representation)
+
+    if args.out_store or args.out_gmt:
+        nodes = json.loads(node_json)
+    if args.out_store:
+        log.info(f"Writing geneset store to {args.out_store}")
+        with Path(args.out_store).open("wb") as stream:
+            write_store(nodes, stream)
+    if args.out_gmt:
+        log.info(f"Writing GMT to {args.out_gmt}")
+        with Path(args.out_gmt).open("w+") as stream:
+            write_gmt(nodes, stream)
+
+    log.info("Finished!")
+
+
+def build_outputs(
+    args: argparse.Namespace, sets: dict, cache: GenesetCache, tables_key: str, trees_key: str
+) -> tuple[str, str]:
+    """Run the actual tree generation, returning the node JSON and repr"""
+    global builder
+
+    # The trees are cached together with the ID builder that made them, so
+    # that the IDs of the pasted tree are the same as if we ran from scratch.
+    cached_trees = cache.get("trees", trees_key)
+    if cached_trees is not None:
+        builder, universe, trees = cached_trees
+    else:
+        # 1. Generate large tables
+        large_tables = cache.get("tables", tables_key)
+        if large_tables is None:
+            log.info(f"Connecting to {args.database_path}...")
+            connection: Connection = connect(args.database_path)
+            log.info("Making large tables...")
+            large_tables = make_large_tables(connection, sets)
+            connection.close()
+            cache.put("tables", tables_key, large_tables)
+
+        log.info(f"Made {len(large_tables)} large tables.")
+
+        universe = GeneUniverse(
+            pd.concat([x["ensg"] for x in large_tables.values()]).dropna()
         )
-        trees[name] = tree
+        log.info(f"Interned {len(universe)} genes.")
+
+        # 2. Generate lists from large tables
+        log.info("Generating gene trees...")
+        trees = {}
+        for name, table in large_tables.items():
+            log.info(f"Processing table {name}")
+            tree = generate_gene_list_trees(
+                table,
+                name,
+                universe,
+                min_pop_score=args.min_pop_score,
+                min_set_size=args.min_set_size,
+                min_recurse_set_size=args.min_recurse_set_size,
+                recurse=not args.no_recurse,
+            )
+            trees[name] = tree
+        cache.put("trees", trees_key, (builder, universe, trees))
 
     # 3. Make the union of the genesets following the structure
     log.info("Pasting trees together...")
-    large_tree = Tree(_id_fn=builder)
+    large_tree = IndexedTree(Tree(_id_fn=builder))
     for source, sink in tqdm(sets["structure"], desc="Merging"):
         if source == "root":
             large_tree.create_node(sink, None)
@@ -181,10 +499,17 @@ def main(args: dict) -> None:
             direction=PruneDirection(args.prune_direction),
         )
 
-    large_tree.to_node_json(Path(args.out_json).open("w+"))
-    large_tree.to_representation(Path(args.out_repr).open("w+"), force_uuid=True)
+    # Turn the bitsets back to gene IDs
+    for node in large_tree.tree.nodes.values():
+        if node.data is not None:
+            node.data = universe.decode(node.data)
 
-    log.info("Finished!")
+    node_json = io.StringIO()
+    large_tree.tree.to_node_json(node_json)
+    representation = io.StringIO()
+    large_tree.tree.to_representation(representation, force_uuid=True)
+
+    return node_json.getvalue(), representation.getvalue()
 
 
 def make_large_tables(conn: Connection, sets: dict) -> dict[pd.DataFrame]:
@@ -238,6 +563,7 @@ def make_large_tables(conn: Connection, sets: dict) -> dict[pd.DataFrame]:
 def generate_gene_list_trees(
     dataframe: pd.DataFrame,
     name: str,
+    universe: GeneUniverse,
     id_col: str = "ensg",
     min_pop_score: float = 0.5,
     min_set_size: int = 10,
@@ -251,6 +577,8 @@ def generate_gene_list_trees(
 
     Args:
         dataframe (pd.DataFrame): The dataframe to source
+        universe (GeneUniverse): The universe used to intern the gene IDs.
+          It must include all IDs in the ID_COL.
         id_col (str, optional): The column to use as IDs. Defaults to "ensg".
         min_pop_score (float, optional): Minimum percentage of non-NA values in
           a column to be considered for gene lists. Defaults to 0.5.
@@ -264,6 +592,7 @@ def generate_gene_list_trees(
 
     Returns:
         Tree: A Tree structure of nodes, where each node contains the geneset
+          as a bitset of the universe.
     """
 
     def generate_list(tree: Tree, father_node_id: str, frame: pd.DataFrame, layer: int):
@@ -292,14 +621,13 @@ def generate_gene_list_trees(
                     )
                     continue
 
-                putative_list = (
-                    frame[id_col][frame[current_col] == value]
-                    .drop_duplicates()
-                    .to_list()
+                putative_set = universe.to_bitset(
+                    frame[id_col][frame[current_col] == value].to_numpy()
                 )
+                set_size = putative_set.bit_count()
 
                 # Skip if the putative gene set is too small
-                if len(putative_list) < min_set_size:
+                if set_size < min_set_size:
                     log.debug(
                         f"Layer {layer} -- col {current_col} -- value {value} ... SKIPPED (too small pure set)"
                     )
@@ -307,7 +635,7 @@ def generate_gene_list_trees(
 
                 node_name = f"{current_col}::{value}"
                 node_id = tree.create_node(
-                    node_name, father_node_id, data=putative_list
+                    node_name, father_node_id, data=putative_set
                 )
 
                 if not recurse:
@@ -316,7 +644,7 @@ def generate_gene_list_trees(
                     )
                     continue
 
-                if len(putative_list) < min_recurse_set_size:
+                if set_size < min_recurse_set_size:
                     log.debug(
                         f"Layer {layer} -- col {current_col} -- value {value} ... ACCEPTED NR (id : {node_id})"
                     )
@@ -339,9 +667,15 @@ def generate_gene_list_trees(
     # Remove the ID col
     all_colnames.remove(id_col)
 
+    # Work on the (int) codes of the IDs, so the sub-frames are cheap to copy.
+    # Rows without an ID are kept, as they count for the population scores
+    # and the value counts, but they are never put in a set.
+    dataframe = dataframe.copy()
+    dataframe[id_col] = universe.encode(dataframe[id_col])
+
     tree = Tree(_id_fn=builder)
     tree_root = tree.create_node(
-        name, parent=None, data=dataframe[id_col].drop_duplicates().to_list()
+        name, parent=None, data=universe.to_bitset(dataframe[id_col].to_numpy())
     )
 
     subtree = generate_list(tree, tree_root, dataframe, 0)
@@ -353,9 +687,7 @@ def generate_gene_list_trees(
     return tree
 
 
-if __name__ == "__main__":
-    import argparse
-
+def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -366,6 +698,15 @@ if __name__ == "__main__":
     )
     parser.add_argument("out_json", type=Path, help="Output tree JSON representation")
     parser.add_argument("out_repr", type=Path, help="Output tree visual representation")
+    parser.add_argument(
+        "--out_store",
+        type=Path,
+        help="Also save the genesets as an indexed binary store (see geneset_store.py)",
+        default=None,
+    )
+    parser.add_argument(
+        "--out_gmt", type=Path, help="Also save the genesets as a .gmt file", default=None
+    )
 
     parser.add_argument(
         "--min_pop_score",
@@ -398,6 +739,12 @@ if __name__ == "__main__":
         help="Direction to prune nodes in",
         default="bottomup",
     )
+    parser.add_argument(
+        "--cache_dir",
+        type=Path,
+        help="Directory to cache intermediate results in. If unset, do not cache.",
+        default=None,
+    )
     parser.add_argument("--verbose", help="Increase verbosity", action="store_true")
     parser.add_argument(
         "--json",
@@ -405,6 +752,12 @@ if __name__ == "__main__":
         action="store_true",
     )
 
+    return parser
+
+
+if __name__ == "__main__":
+    parser = make_parser()
+
     args = parser.parse_args()
 
     if args.verbose:
@@ -0,0 +1,466 @@
+"""Shared readers for the (large) expression matrices
+
+The matrices come in `data/in` as gzipped .tsv files. Instead of unpacking
+and reformatting them to .csv before every analysis, the modules read them
+through here, straight from the compressed files:
+    - `read_matrix` loads a whole matrix with Arrow. Arrow decompresses the
+      file on its readahead thread while the blocks are parsed in parallel
+      on the other threads;
+    - `read_expression` does the same, but with compact types: float32
+      numbers and categorical IDs, which take about half the memory;
+    - `open_text` streams the lines of a file, with the decompression done
+      on a separate thread, for modules that process one row at a time;
+    - `stream_arrow` and `write_batch` read and write a matrix one block of
+      rows at a time, for modules that should work in constant memory;
+    - `read_and_join` reads many matrices at once and joins them on their
+      ID columns in a single pass, see `join_frames`.
+
+The delimiter is guessed from the extension: `.tsv` files (compressed or
+not) are tab-separated, anything else is comma-separated.
+"""
+
+from __future__ import annotations
+
+import csv
+import gzip
+import io
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional, TextIO, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+
+log = logging.getLogger(__name__)
+
+# Size of the blocks that are decompressed and parsed at once
+BLOCK_SIZE = 16 * 2**20
+
+
+def delimiter_of(path: Path) -> str:
+    """Guess the delimiter of a file from its extension(s)"""
+    return "\t" if ".tsv" in Path(path).suffixes else ","
+
+
+def is_compressed(path: Path) -> bool:
+    return Path(path).suffix == ".gz"
+
+
+class ThreadedDecompressor(io.RawIOBase):
+    """A gzipped file, decompressed on a background thread
+
+    The thread decompresses blocks ahead of the reader (up to `prefetch` of
+    them), so decompression and processing of the data overlap.
+    """
+
+    def __init__(self, path: Path, block_size: int = BLOCK_SIZE, prefetch: int = 4):
+        self.blocks = queue.Queue(maxsize=prefetch)
+        # The current block, and how much of it was already read. Slicing
+        # the consumed bytes off would copy the rest of the block every time
+        self.buffer = memoryview(b"")
+        self.offset = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(
+            target=self._decompress, args=(Path(path), block_size), daemon=True
+        )
+        self.thread.start()
+
+    def _decompress(self, path: Path, block_size: int) -> None:
+        try:
+            with gzip.open(path, "rb") as stream:
+                while not self.stop.is_set():
+                    block = stream.read(block_size)
+                    self._put(block)
+                    if not block:
+                        return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item) -> None:
+        # Do not block forever if the reader went away
+        while not self.stop.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self.offset == len(self.buffer):
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                # Leave the sentinel for any other reads after the end
+                self.blocks.put(block)
+                return 0
+            self.buffer = memoryview(block)
+            self.offset = 0
+        size = min(len(buffer), len(self.buffer) - self.offset)
+        buffer[:size] = self.buffer[self.offset : self.offset + size]
+        self.offset += size
+        return size
+
+    def close(self) -> None:
+        self.stop.set()
+        super().close()
+
+
+def open_binary(path: Path) -> BinaryIO:
+    """Open a (possibly gzipped) file for reading, as bytes"""
+    if is_compressed(path):
+        return io.BufferedReader(ThreadedDecompressor(path), buffer_size=2**20)
+    return Path(path).open("rb")
+
+
+def open_text(path: Path) -> TextIO:
+    """Open a (possibly gzipped) file for reading, as text"""
+    return io.TextIOWrapper(open_binary(path), encoding="utf-8", newline="")
+
+
+def read_header(path: Path, delimiter: Optional[str] = None) -> list[str]:
+    """Read just the column names of a matrix"""
+    with open_text(path) as stream:
+        return next(csv.reader(stream, delimiter=delimiter or delimiter_of(path)))
+
+
+def read_arrow(
+    path: Union[Path, BinaryIO],
+    columns: Optional[list[str]] = None,
+    column_types: Optional[dict] = None,
+    delimiter: Optional[str] = None,
+) -> pa.Table:
+    """Read a (possibly gzipped) .csv or .tsv file as an Arrow table
+
+    Args:
+        path (Path | BinaryIO): The path to the file, or an open binary
+          stream of an uncompressed file (like the members of a tarball).
+        columns (list[str], optional): Read only these columns.
+        column_types (dict, optional): Column name -> Arrow type of columns
+          whose type should not be inferred.
+        delimiter (str, optional): The delimiter of the file. Guessed from
+          the extension if not given (or if `path` is a stream, a comma).
+    """
+    if isinstance(path, (str, Path)):
+        source = pa.input_stream(str(path), compression="detect")
+        delimiter = delimiter or delimiter_of(path)
+    else:
+        # There is no extension to guess from, so streams are read as they are
+        source = pa.input_stream(path)
+        delimiter = delimiter or ","
+
+    log.info(f"Reading {path}...")
+    with source as stream:
+        table = pacsv.read_csv(
+            stream,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=BLOCK_SIZE),
+            parse_options=pacsv.ParseOptions(delimiter=delimiter),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=columns, column_types=column_types
+            ),
+        )
+    log.info(f"Read {table.num_rows} rows and {table.num_columns} columns from {path}")
+    return table
+
+
+def read_matrix(
+    path: Path,
+    columns: Optional[list[str]] = None,
+    delimiter: Optional[str] = None,
+) -> pd.DataFrame:
+    """Read a (possibly gzipped) .csv or .tsv file as a DataFrame
+
+    See `read_arrow`.
+    """
+    return read_arrow(path, columns, delimiter=delimiter).to_pandas()
+
+
+def stream_arrow(
+    source: Union[Path, BinaryIO],
+    delimiter: Optional[str] = None,
+    column_types: Optional[dict] = None,
+    column_names: Optional[list[str]] = None,
+) -> pacsv.CSVStreamingReader:
+    """Read a (possibly gzipped) .csv or .tsv file one block of rows at a time
+
+    The source can also be an open binary stream (e.g. stdin), in which
+    case the delimiter defaults to a comma. Iterate on the result to get the
+    blocks, as `pyarrow.RecordBatch`es.
+
+    The types of the columns not in `column_types` are inferred from the
+    first block only, so later blocks that do not fit them (e.g. decimals in
+    a column that was all integers) fail to convert.
+
+    If the header was already read from the stream, give the names of the
+    columns as `column_names`.
+    """
+    if isinstance(source, (str, Path)):
+        delimiter = delimiter or delimiter_of(source)
+        source = pa.input_stream(str(source), compression="detect")
+    return pacsv.open_csv(
+        source,
+        read_options=pacsv.ReadOptions(
+            use_threads=True, block_size=BLOCK_SIZE, column_names=column_names
+        ),
+        parse_options=pacsv.ParseOptions(delimiter=delimiter or ","),
+        convert_options=pacsv.ConvertOptions(column_types=column_types),
+    )
+
+
+def write_header(columns: list[str], stream: BinaryIO, delimiter: str = ",") -> None:
+    header = io.StringIO()
+    csv.writer(header, delimiter=delimiter, lineterminator="\n").writerow(columns)
+    stream.write(header.getvalue().encode("utf-8"))
+
+
+def needs_quoting(table: Union[pa.Table, pa.RecordBatch], delimiter: str) -> bool:
+    """Check if some string values in a table need to be quoted"""
+    for column in table.columns:
+        # Categorical IDs (see `read_expression`) are dictionaries of strings
+        if pa.types.is_dictionary(column.type):
+            column = column.cast(column.type.value_type)
+        if not pa.types.is_string(column.type) and not pa.types.is_large_string(column.type):
+            continue
+        if pc.any(pc.match_substring_regex(column, f"[\"\n\r{delimiter}]")).as_py():
+            return True
+    return False
+
+
+def write_batch(
+    batch: Union[pa.Table, pa.RecordBatch], stream: BinaryIO, delimiter: str = ","
+) -> None:
+    """Write the rows of a table to a binary stream, without the header
+
+    Like `pandas.DataFrame.to_csv`, values are only quoted if they need to be.
+    """
+    if needs_quoting(batch, delimiter):
+        # Arrow would quote all strings, even if there is no need to
+        text = batch.to_pandas().to_csv(
+            sep=delimiter, index=False, header=False, lineterminator="\n"
+        )
+        stream.write(text.encode("utf-8"))
+        return
+
+    options = pacsv.WriteOptions(
+        include_header=False, delimiter=delimiter, quoting_style="none"
+    )
+    pacsv.write_csv(batch, stream, write_options=options)
+
+
+def write_matrix(frame: pd.DataFrame, path: Path) -> None:
+    """Write a DataFrame (without its index) to a .csv or .tsv file
+
+    This is much faster than `pandas.DataFrame.to_csv` for large numeric
+    frames. Like `to_csv`, values are only quoted if they need to be.
+    """
+    delimiter = delimiter_of(path)
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+
+    compression = "gzip" if is_compressed(path) else None
+    with pa.output_stream(str(path), compression=compression) as stream:
+        write_header(list(frame.columns), stream, delimiter)
+        write_batch(table, stream, delimiter)
+
+
+def memory_footprint(frame: pd.DataFrame) -> int:
+    """Get the size of a DataFrame in memory, in bytes"""
+    return int(frame.memory_usage(index=True, deep=True).sum())
+
+
+def read_expression(
+    path: Union[Path, BinaryIO],
+    columns: Optional[list[str]] = None,
+    id_cols: Optional[list[str]] = None,
+    delimiter: Optional[str] = None,
+    float_type: Optional[pa.DataType] = pa.float32(),
+) -> pd.DataFrame:
+    """Read a (possibly gzipped) expression matrix with compact types
+
+    Floating point columns are read as float32, which is more than enough
+    for expression values. The ID columns are read as categories (with
+    sorted categories, so they sort like the original strings).
+
+    Files that are only read to be written out again (like the rankings)
+    should keep their floats as they are, with `float_type=None`, or the
+    values written out lose their precision.
+
+    Args:
+        path (Path | BinaryIO): The path to the file, or a stream, see
+          `read_arrow`.
+        columns (list[str], optional): Read only these columns.
+        id_cols (list[str], optional): The ID columns. If not given, all
+          the string columns are treated as IDs.
+        delimiter (str, optional): The delimiter of the file. Guessed from
+          the extension if not given.
+        float_type (pa.DataType, optional): The type of the floating point
+          columns. If None, they are kept as read (float64).
+    """
+    table = read_arrow(path, columns, delimiter=delimiter)
+
+    arrays = []
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_floating(column.type) and float_type is not None:
+            column = column.cast(float_type)
+        elif pa.types.is_string(column.type) and (id_cols is None or name in id_cols):
+            column = column.dictionary_encode()
+        arrays.append(column)
+    frame = pa.Table.from_arrays(arrays, names=table.column_names).to_pandas()
+
+    for name in frame.columns:
+        if isinstance(frame[name].dtype, pd.CategoricalDtype):
+            frame[name] = frame[name].cat.reorder_categories(
+                sorted(frame[name].cat.categories)
+            )
+
+    log.info(
+        f"Frame from {path} takes {memory_footprint(frame) / 2**20:.1f} MiB in memory"
+    )
+    return frame
+
+
+def _factorize_ids(
+    frames: list[pd.DataFrame], on: list[str], sort: bool
+) -> tuple[list[np.ndarray], list[pd.Index]]:
+    """Give the same integer code to the same IDs in all the frames
+
+    Returns the codes of the rows of each frame, and the values of each ID
+    column for each code. Categorical columns are coded through their
+    categories, so the (many) repeated strings are never hashed.
+    """
+    lengths = np.cumsum([len(frame) for frame in frames])[:-1]
+    column_codes = []
+    column_uniques = []
+    for name in on:
+        values = []
+        local_codes = []
+        for frame in frames:
+            column = frame[name]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                values.append(column.cat.categories.to_numpy())
+                local_codes.append(column.cat.codes.to_numpy())
+            else:
+                values.append(column.to_numpy())
+                local_codes.append(None)
+            if column.isna().any():
+                raise ValueError(f"Missing values in ID column {name}")
+
+        codes, uniques = pd.factorize(np.concatenate(values), sort=sort)
+        codes = np.split(codes, np.cumsum([len(x) for x in values])[:-1])
+        codes = [
+            part if local is None else part[local]
+            for part, local in zip(codes, local_codes)
+        ]
+        column_codes.append(np.concatenate(codes))
+        column_uniques.append(pd.Index(uniques))
+
+    if len(on) == 1:
+        return np.split(column_codes[0], lengths), column_uniques
+
+    # Many ID columns: code the combinations of the codes of each column
+    shape = tuple(len(x) for x in column_uniques)
+    combined = np.ravel_multi_index(column_codes, shape)
+    codes, combinations = pd.factorize(combined, sort=sort)
+    uniques = [
+        values.take(x)
+        for values, x in zip(column_uniques, np.unravel_index(combinations, shape))
+    ]
+    return np.split(codes, lengths), uniques
+
+
+def join_frames(
+    frames: list[pd.DataFrame], on: Union[str, list[str]], how: str = "inner"
+) -> pd.DataFrame:
+    """Join many frames on their ID columns, all at once
+
+    This gives the same rows as folding `pd.merge` over the frames, but the
+    IDs are hashed only once (all together) and each column is copied only
+    once, to its final place, so the time is linear in the total size.
+
+    The IDs must be unique in each frame, and the other columns must have
+    different names in different frames.
+
+    Args:
+        frames (list[pd.DataFrame]): The frames to join.
+        on (str | list[str]): The ID column(s), that all frames have.
+        how (str): Either "inner", to keep only the IDs in all frames (in the
+          order of the first frame), or "outer", to keep all IDs (sorted).
+    """
+    on = [on] if isinstance(on, str) else list(on)
+    if how not in ("inner", "outer"):
+        raise ValueError(f"Unsupported join type: {how}")
+    if not frames:
+        raise ValueError("No frames to join")
+
+    names = [x for frame in frames for x in frame.columns if x not in on]
+    if len(names) != len(set(names)):
+        raise ValueError("Some columns to join have the same name")
+
+    # The ID index: one code per unique ID, over all the frames
+    codes, uniques = _factorize_ids(frames, on, sort=how == "outer")
+    # How many frames have each ID
+    counts = np.zeros(len(uniques[0]), dtype=int)
+    for frame, frame_codes in zip(frames, codes):
+        frame_counts = np.bincount(frame_codes, minlength=len(counts))
+        if frame_counts.max(initial=0) > 1:
+            raise ValueError(
+                f"Duplicated IDs in frame with columns {list(frame.columns)}"
+            )
+        counts += frame_counts
+
+    if how == "inner":
+        keep = codes[0][counts[codes[0]] == len(frames)]
+    else:
+        keep = np.arange(len(uniques[0]))
+
+    # Where each ID ends up in the result (-1 if it is dropped)
+    position = np.full(len(uniques[0]), -1)
+    position[keep] = np.arange(len(keep))
+
+    result = {name: values.take(keep) for name, values in zip(on, uniques)}
+    for frame, frame_codes in zip(frames, codes):
+        rows = position[frame_codes]
+        found = rows >= 0
+        # The row of the frame that goes in each row of the result
+        indexer = np.full(len(keep), -1)
+        indexer[rows[found]] = np.nonzero(found)[0]
+        fill = how == "outer" and (indexer < 0).any()
+        for name in frame.columns:
+            if name in on:
+                continue
+            result[name] = pd.api.extensions.take(
+                frame[name].array, indexer, allow_fill=fill
+            )
+
+    return pd.DataFrame(result)
+
+
+def read_and_join(
+    paths: list[Path],
+    on: Union[str, list[str]],
+    how: str = "inner",
+    reader: Callable[[Path], pd.DataFrame] = read_expression,
+    jobs: Optional[int] = None,
+) -> pd.DataFrame:
+    """Read many files on a pool of threads, and join them with `join_frames`
+
+    Arrow releases the GIL while parsing, so the files are read in parallel.
+
+    Args:
+        paths (list[Path]): The files to read.
+        on (str | list[str]): The ID column(s), that all files have.
+        how (str): Either "inner" or "outer", see `join_frames`.
+        reader (Callable): How to read each file, by default `read_expression`.
+        jobs (int, optional): Number of files to read at once.
+    """
+    with ThreadPoolExecutor(jobs) as pool:
+        frames = list(pool.map(reader, paths))
+    return join_frames(frames, on, how)
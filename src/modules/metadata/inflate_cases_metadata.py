@@ -1,18 +1,26 @@
 import pandas as pd
+import sys
 from pathlib import Path
 from typing import Callable
 
 from sys import stdout, stderr
 
+# The shared readers live in the modules folder
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from metaquery import write_index
+
 def eprint(*args, **kwargs):
     print(*args, file=stderr, **kwargs)
 
-def clean_ids(ids: list[str]) -> list[str]:
-    for id in ids:
-        if not id.startswith("TCGA") and len(id) != 15:
-            yield id
-            continue
-        yield id[:12]
+def clean_ids(ids: pd.Series) -> pd.Series:
+    """Get the case IDs of the samples
+
+    TCGA sample IDs (and any other 15-character ID) are the case ID plus a
+    suffix, so they are cut to the first 12 characters. Other IDs are kept.
+    """
+    keep = ~ids.str.startswith("TCGA") & (ids.str.len() != 15)
+    return ids.where(keep, ids.str.slice(0, 12))
 
 def split_path(path: str, default_col: Callable = lambda: "samples") -> (Path, str):
     """For compactdness I use the /path/to/file.csv@column_with_ids shorthand
@@ -54,7 +62,7 @@ def main(case_path, sample_path, case_col, sample_col):
 
     eprint("Inflating case metadata to sample metadata")
 
-    samples["case_id"] = list(clean_ids(samples[sample_col].to_list()))
+    samples["case_id"] = clean_ids(samples[sample_col].astype(str))
 
     data = samples.merge(cases, left_on="case_id", right_on=case_col, how="outer", validate="many_to_one")
 
@@ -70,6 +78,14 @@ if __name__ == "__main__":
     
     parser.add_argument("case_metadata", type=str)
     parser.add_argument("sample_metadata", type=str)
+    parser.add_argument(
+        "--drop", nargs="+", default=[], help="Column(s) to leave out of the output"
+    )
+    parser.add_argument(
+        "--index",
+        type=Path,
+        help="Also save the output as a metadata index (.arrow) for the DEA queries",
+    )
 
     args = parser.parse_args()
     
@@ -77,5 +93,10 @@ if __name__ == "__main__":
     sample_path, sample_col = split_path(args.sample_metadata)
 
     data = main(case_path=case_path, sample_path=sample_path, case_col=case_col, sample_col=sample_col)
+    data = data.drop(columns=args.drop)
+
+    if args.index:
+        eprint(f"Saving metadata index to {args.index}")
+        write_index(data, args.index, sample_col)
 
     data.to_csv(stdout, index=False)
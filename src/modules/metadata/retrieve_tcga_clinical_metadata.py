@@ -1,20 +1,44 @@
 """Ask the GDC data portal for clinical information. Unpack it (clean it) from
 the JSON and paste it inside a Pandas Dataframe together with the standard
 patient identifier.
+
+The requests are made concurrently on a pool of connections, are retried (with
+backoff) if they fail, and can be cached on disk. The cases are asked for one
+page at a time, and each study is written out as soon as it is ready.
+
+The data types of a study are merged on the patient ID, so each study is
+held whole in memory until it is written. With 'ALL', only a few studies are
+downloaded at once (see `get_clinical_data`), so memory use is bounded by
+the size of those few studies, not by the size of all of them.
 """
 
+import csv
+import hashlib
 import json
 import logging
+import os
+import tempfile
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
+from pathlib import Path
+from typing import Iterator, Optional, TextIO
 
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from sys import stdout
 
 logging.basicConfig(format="%(asctime)s %(funcName)s@%(filename)s [%(levelname)s]: %(message)s", level=logging.INFO)
 log = logging.getLogger("asclepius") # A famous greek clinician
 
+CASES_ENDPOINT = "https://api.gdc.cancer.gov/cases/"
+DATA_TYPES = ["diagnoses", "demographic", "exposures"]
+# Number of cases to ask for in each request
+PAGE_SIZE = 1000
+
 ALL_STUDIES = [f"TCGA-{x}" for x in (
         "LAML",
         "ACC",
@@ -52,60 +76,145 @@ ALL_STUDIES = [f"TCGA-{x}" for x in (
         "UVM"
     )]
 
-def call_portal(project_id: str, number: int = 1_000_000):
-    """Retrieves clinical data regarding a project from the GDC database
+class ResponseCache:
+    """Responses of the portal, saved on disk and keyed by the request URL"""
 
-    Requires an internet connection. Downloads data regarding all patients in
-    the project (up to 'number'), and will then merge it into a single pandas
-    DataFrame for manipulation.
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
 
-    Writes all information in a log file in the same folder as the script.
+    def _file(self, url: str) -> Path:
+        return self.path / f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json"
 
-    Args:
-        project_id : The project's ID, such as TCGA-BRCA
-        number: Download the first "number" of patients, up to all patients.
-            This should generally be kept as a large enough values. Defaults
-            to 1_000_000
+    def get(self, url: str) -> Optional[bytes]:
+        file = self._file(url)
+        if not file.exists():
+            return None
+        return file.read_bytes()
 
-    Returns:
-        Pandas dataframe containing clinical information
+    def put(self, url: str, content: bytes) -> None:
+        handle, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(handle, "wb") as stream:
+            stream.write(content)
+        os.replace(tmp_path, self._file(url))
+
+
+def make_session(pool_size: int = 10, retries: int = 5) -> requests.Session:
+    """Make a session with a pool of `pool_size` connections
+
+    Failed requests (and those that get a 429 or 5xx response) are retried
+    up to `retries` times, waiting exponentially longer every time.
     """
+    retry = Retry(
+        total=retries,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-    cases_endpt = "https://api.gdc.cancer.gov/cases/"
+
+def fetch_json(session: requests.Session, endpoint: str, params: dict, cache: Optional[ResponseCache] = None) -> dict:
+    """GET a JSON from the portal, or from the cache if it is there"""
+    url = requests.Request("GET", endpoint, params=params).prepare().url
+
+    content = cache.get(url) if cache else None
+    if content is not None:
+        log.info(f"Using cached response for {url}")
+    else:
+        start = time.perf_counter()
+        response = session.get(url)
+        response.raise_for_status()
+        content = response.content
+        log.info(
+            f"Received {len(content)} bytes in {(time.perf_counter() - start):.2f} seconds"
+        )
+        if cache:
+            cache.put(url, content)
+
+    return json.loads(content)
+
+
+def fetch_case_pages(session: requests.Session, project_id: str, data_type: str, number: int = 1_000_000, endpoint: str = CASES_ENDPOINT, cache: Optional[ResponseCache] = None, page_size: int = PAGE_SIZE) -> Iterator[list[dict]]:
+    """Get the cases of a project, expanded with some data type, page by page"""
     filters = {
         "op": "=",
         "content": {"field": "project.project_id", "value": project_id},
     }
-    data_types = ["diagnoses", "demographic", "exposures"]
-
-    dataframes = []
-
-    for data_type in data_types:
+    number = int(number)
+    start = 0
+    while start < number:
         params = {
             "filters": json.dumps(filters),
             "format": "JSON",
             "expand": data_type,
+            "from": str(start),
+            # Without an explicit order, the pages are not guaranteed to
+            # split the cases in the same way from one request to the next
+            "sort": "submitter_id:asc",
             # Omission of the int makes the value have a dot (100.0)
             # and it causes an **internal server error**!!! 
             # WTF GDC, come on.
-            "size": str(int(number)),
+            "size": str(min(int(page_size), number - start)),
         }
-        log.info(f"Calling GDC portal for {data_type} data")
-        start = time.perf_counter()
-        response = requests.get(cases_endpt, params=params)
-        response.raise_for_status()
-        log.info(
-            f"Received {len(response.content)} bytes in {(time.perf_counter() - start):.2f} seconds"
-        )
-        warnings = json.loads(response.content.decode("utf-8"))["warnings"]
+        log.info(f"Calling GDC portal for {data_type} data of {project_id} (from {start})")
+        decoded = fetch_json(session, endpoint, params, cache)
+
+        warnings = decoded["warnings"]
         if warnings:
             log.warning(f"There were some warnings when downloading data: {warnings}")
-        # Decode and unpack the JSON response
-        decoded_response = json.loads(response.content.decode("utf-8"))["data"]["hits"]
-        # Clean up the data, and put it in a dataframe ------------------------
-        missing_diagnoses = []
-        cases = []
-        for patient in decoded_response:
+
+        hits = decoded["data"]["hits"]
+        if not hits:
+            return
+        yield hits
+
+        start += len(hits)
+        if start >= decoded["data"]["pagination"]["total"]:
+            return
+
+
+class ColumnBuffer:
+    """Rows of a table, stored column by column
+
+    Rows can have different keys. The columns are in order of appearance,
+    and missing values are None, like when making a DataFrame from dicts.
+
+    Columns are only padded with the missing values when they get a new
+    value (or at the end), so appending a row only touches its own keys.
+    """
+
+    def __init__(self):
+        self.columns: dict[str, list] = {}
+        self.n_rows = 0
+
+    def append(self, row: dict) -> None:
+        for key, value in row.items():
+            column = self.columns.setdefault(key, [])
+            if len(column) < self.n_rows:
+                column.extend([None] * (self.n_rows - len(column)))
+            column.append(value)
+        self.n_rows += 1
+
+    def to_frame(self) -> pd.DataFrame:
+        for column in self.columns.values():
+            column.extend([None] * (self.n_rows - len(column)))
+        return pd.DataFrame(self.columns)
+
+
+def collect_cases(pages: Iterator[list[dict]], data_type: str) -> pd.DataFrame:
+    """Unpack the cases of a project, expanded with some data type
+
+    Each page is unpacked, and can be forgotten, as soon as it arrives.
+    """
+    missing_diagnoses = []
+    cases = ColumnBuffer()
+    for hits in pages:
+        for patient in hits:
             clean_data = {}
             try:
                 if data_type != "demographic":
@@ -120,14 +229,22 @@ def call_portal(project_id: str, number: int = 1_000_000):
             # Add the relevant patient ID to the cleaned data for merging
             clean_data.update({"submitter_id": patient["submitter_id"]})
             cases.append(clean_data)
-        # Warn the user if something went wrong when retrieving the data
-        if missing_diagnoses:
-            str_missing_diagnoses = ", ".join(missing_diagnoses)
-            log.warning(
-                f"I found one or more missing {data_type}: {str_missing_diagnoses}"
-            )
-        # Finally, add the dataframe to the dataframe list
-        dataframes.append(pd.DataFrame(cases))
+    # Warn the user if something went wrong when retrieving the data
+    if missing_diagnoses:
+        str_missing_diagnoses = ", ".join(missing_diagnoses)
+        log.warning(
+            f"I found one or more missing {data_type}: {str_missing_diagnoses}"
+        )
+    return cases.to_frame()
+
+
+def fetch_cases(session: requests.Session, project_id: str, data_type: str, number: int = 1_000_000, endpoint: str = CASES_ENDPOINT, cache: Optional[ResponseCache] = None, page_size: int = PAGE_SIZE) -> pd.DataFrame:
+    """Get and unpack the cases of a project, expanded with some data type"""
+    pages = fetch_case_pages(session, project_id, data_type, number, endpoint, cache, page_size)
+    return collect_cases(pages, data_type)
+
+
+def merge_data_types(dataframes: list[pd.DataFrame], project_id: str) -> pd.DataFrame:
     log.info("Dropping useless columns")
     clean_dframes = []
     for i in dataframes:
@@ -143,32 +260,110 @@ def call_portal(project_id: str, number: int = 1_000_000):
     return merged_frame
 
 
-def get_clinical_data(project_id: str, number: int):
+def call_portal(project_id: str, number: int = 1_000_000, session: Optional[requests.Session] = None, endpoint: str = CASES_ENDPOINT, cache: Optional[ResponseCache] = None, page_size: int = PAGE_SIZE):
+    """Retrieves clinical data regarding a project from the GDC database
+
+    Requires an internet connection (or a cache with the responses).
+    Downloads data regarding all patients in the project (up to 'number'),
+    and will then merge it into a single pandas DataFrame for manipulation.
+
+    Args:
+        project_id : The project's ID, such as TCGA-BRCA
+        number: Download the first "number" of patients, up to all patients.
+            This should generally be kept as a large enough values. Defaults
+            to 1_000_000
+        session: The session to make the requests with.
+        endpoint: The URL of the cases endpoint of the portal.
+        cache: A cache for the responses of the portal.
+        page_size: The number of patients to ask for in each request.
+
+    Returns:
+        Pandas dataframe containing clinical information
+    """
+    session = session or make_session()
+    dataframes = [
+        fetch_cases(session, project_id, data_type, number, endpoint, cache, page_size)
+        for data_type in DATA_TYPES
+    ]
+    return merge_data_types(dataframes, project_id)
+
+
+class StudyWriter:
+    """Write studies with (possibly) different columns to one .csv
+
+    Each study is saved to a temporary file as soon as it is written. When
+    all studies are in, they are copied, row by row, to the output, with
+    all the columns of all the studies.
+    """
+
+    def __init__(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.parts: list[Path] = []
+        self.columns: dict[str, None] = {}
+
+    def write(self, frame: pd.DataFrame) -> None:
+        part = Path(self.dir.name) / f"{len(self.parts)}.csv"
+        frame.to_csv(part, index=False)
+        self.parts.append(part)
+        self.columns.update(dict.fromkeys(frame.columns))
+
+    def finish(self, stream: TextIO) -> None:
+        writer = csv.DictWriter(stream, fieldnames=list(self.columns), restval="", lineterminator="\n")
+        writer.writeheader()
+        for part in self.parts:
+            with part.open("r", newline="") as part_stream:
+                writer.writerows(csv.DictReader(part_stream))
+        self.dir.cleanup()
+
+
+def get_clinical_data(project_id: str, number: int, endpoint: str = CASES_ENDPOINT, cache_dir: Optional[Path] = None, jobs: int = 8, page_size: int = PAGE_SIZE):
     """Retrieves clinical data from the GDC data portal given a TCGA ID
 
     Gets data from the first NUMBER patients (default to 1 Million) in the
     TCGA project with id PROJECT_ID, and save them in csv format to OUTPUT_FILE.
 
+    With 'ALL', the projects are downloaded concurrently, with at most JOBS
+    requests at once.
+
     The missing values are replaced with the string "not reported",
     like TCGA does with their missing variables.
     """
-    
+    cache = ResponseCache(cache_dir) if cache_dir else None
+    session = make_session(pool_size=jobs)
+
     if project_id != "ALL":
-        call_portal(project_id, number).to_csv(stdout, index = False)
+        call_portal(project_id, number, session, endpoint, cache, page_size).to_csv(stdout, index = False)
         return
-    
-    all_data = []
-    for id in ALL_STUDIES:
-        log.info(f"Retrieving {id}..")
-        all_data.append(call_portal(id, number))
 
-    log.info("Collating all studies together")
-    # use pd.concat
-    
-    merged_frame = pd.concat(all_data)
-    
+    writer = StudyWriter()
+    # Only download a few studies ahead of the one we are writing, so that
+    # they do not pile up in memory
+    window = jobs // len(DATA_TYPES) + 1
+    with ThreadPoolExecutor(jobs) as pool:
+        pending = deque()
+        studies = iter(ALL_STUDIES)
 
-    merged_frame.to_csv(stdout, index=False)
+        def submit_next():
+            id = next(studies, None)
+            if id is None:
+                return
+            futures = [
+                pool.submit(fetch_cases, session, id, data_type, number, endpoint, cache, page_size)
+                for data_type in DATA_TYPES
+            ]
+            pending.append((id, futures))
+
+        for _ in range(window):
+            submit_next()
+
+        while pending:
+            id, futures = pending.popleft()
+            submit_next()
+            log.info(f"Retrieving {id}..")
+            writer.write(merge_data_types([x.result() for x in futures], id))
+
+    log.info("Collating all studies together")
+    writer.finish(stdout)
 
 
 
@@ -179,8 +374,12 @@ if __name__ == "__main__":
 
     parser.add_argument("project_id", help="TCGA shorthand project to download, e.g. 'TCGA-BRCA'. If 'ALL', downloads all studies.")
     parser.add_argument("--number", help="Number of patients to retrieve", default=1e6)
+    parser.add_argument("--endpoint", help="URL of the cases endpoint of the GDC portal", default=CASES_ENDPOINT)
+    parser.add_argument("--cache-dir", type=Path, help="Save the responses of the portal in this folder, and reuse them")
+    parser.add_argument("--jobs", type=int, default=8, help="Maximum number of requests to make at once")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Number of patients to ask for in each request")
 
     args = parser.parse_args()
 
-    get_clinical_data(args.project_id, args.number)
+    get_clinical_data(args.project_id, args.number, args.endpoint, args.cache_dir, args.jobs, args.page_size)
 
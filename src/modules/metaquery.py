@@ -0,0 +1,191 @@
+"""In-process selection of matrix columns with metasplit-style queries
+
+The DEA queries select samples with the syntax of `metasplit`:
+
+    path/to/metadata.csv@id_col?variable=value&other!=[value one,value two]
+
+which selects the values in `id_col` of the rows in the metadata where
+`variable` is `value` and `other` is neither `value one` nor `value two`.
+Many queries for the same selection are joined together (union).
+
+Running `metasplit` means writing a copy of the (large) matrix for every
+selection, so here we just resolve the queries to the list of columns to
+take from the matrix, that is already in memory.
+
+Queries can also point to a metadata index (an `.arrow` file, see
+`write_index`), that is memory mapped instead of read. The index holds the
+clinical metadata of the cases inflated to the samples, so queries on it
+select the samples of the matching cases, whatever their ID column is.
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+from dataclasses import dataclass
+from functools import cache
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from matrix_io import read_arrow, read_header
+
+log = logging.getLogger(__name__)
+
+META_PLACEHOLDER = "<meta>"
+CLINICAL_PLACEHOLDER = "<clinical>"
+
+INDEX_SUFFIX = ".arrow"
+# Key in the schema metadata of an index with the name of the sample column
+INDEX_SAMPLE_KEY = b"sample_col"
+
+QUERY_RE = re.compile(r"^(?P<path>.+)@(?P<id_col>[^?]+)(\?(?P<filters>.*))?$")
+FILTER_RE = re.compile(r"^(?P<variable>[^!=]+)(?P<operator>!?=)(?P<values>.*)$")
+
+
+@dataclass
+class Filter:
+    variable: str
+    values: list[str]
+    negated: bool = False
+
+    def mask(self, metadata: pa.Table) -> pa.ChunkedArray:
+        if self.variable not in metadata.column_names:
+            raise ValueError(f"Metadata has no variable named {self.variable}")
+        column = metadata[self.variable]
+        values = pa.array(self.values, type=column.type)
+        # Missing values match nothing, like in `metasplit`
+        mask = pc.fill_null(pc.is_in(column, value_set=values), False)
+        return pc.invert(mask) if self.negated else mask
+
+
+@dataclass
+class Query:
+    path: Path
+    id_col: str
+    filters: list[Filter]
+
+    @staticmethod
+    def parse(
+        query: str,
+        metadata_path: Path | None = None,
+        clinical_path: Path | None = None,
+    ) -> Query:
+        """Parse a query string
+
+        The `<meta>` and `<clinical>` placeholders in the path are replaced by
+        `metadata_path` and `clinical_path`, if given.
+        """
+        for placeholder, path in (
+            (META_PLACEHOLDER, metadata_path),
+            (CLINICAL_PLACEHOLDER, clinical_path),
+        ):
+            if path is not None:
+                query = query.replace(
+                    placeholder, str(Path(path).expanduser().absolute())
+                )
+
+        match = QUERY_RE.match(query)
+        if match is None:
+            raise ValueError(f"Invalid query: {query}")
+
+        filters = []
+        for item in (match["filters"] or "").split("&"):
+            if not item:
+                continue
+            filter_match = FILTER_RE.match(item)
+            if filter_match is None:
+                raise ValueError(f"Invalid filter '{item}' in query: {query}")
+            values = filter_match["values"]
+            if values.startswith("[") and values.endswith("]"):
+                values = values[1:-1].split(",")
+            else:
+                values = [values]
+            filters.append(
+                Filter(
+                    variable=filter_match["variable"],
+                    values=values,
+                    negated=filter_match["operator"] == "!=",
+                )
+            )
+
+        return Query(path=Path(match["path"]), id_col=match["id_col"], filters=filters)
+
+    def resolve(self) -> list[str]:
+        """Get the IDs selected by this query, in metadata order
+
+        For indexes, these are always the IDs of the samples.
+        """
+        metadata = read_metadata(self.path)
+        id_col = self.id_col
+        if metadata.schema.metadata and INDEX_SAMPLE_KEY in metadata.schema.metadata:
+            id_col = metadata.schema.metadata[INDEX_SAMPLE_KEY].decode("utf-8")
+        if id_col not in metadata.column_names:
+            raise ValueError(f"Metadata {self.path} has no column {id_col}")
+        mask = pa.chunked_array([pa.array([True] * metadata.num_rows)])
+        for item in self.filters:
+            mask = pc.and_(mask, item.mask(metadata))
+        return metadata.filter(mask)[id_col].to_pylist()
+
+
+@cache
+def read_metadata(path: Path) -> pa.Table:
+    """Read (and keep around) a metadata file, with all values as strings
+
+    Indexes are memory mapped, and not read at all.
+    """
+    if path.suffix == INDEX_SUFFIX:
+        return pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+    header = read_header(path)
+    return read_arrow(path, column_types={x: pa.string() for x in header})
+
+
+def write_index(frame: pd.DataFrame, path: Path, sample_col: str) -> None:
+    """Save sample-level metadata as an index, for queries to memory map
+
+    All values are saved as strings, like `read_metadata` reads them.
+    """
+    table = pa.Table.from_pandas(frame.astype("string"), preserve_index=False)
+    table = table.replace_schema_metadata(
+        {INDEX_SAMPLE_KEY: sample_col.encode("utf-8")}
+    )
+    # No compression, or the file could not be memory mapped
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def select_columns(
+    queries: list[str],
+    columns: list[str],
+    metadata_path: Path | None = None,
+    always_include: list[str] | None = None,
+    clinical_path: Path | None = None,
+    intersect: bool = False,
+) -> list[str]:
+    """Select the columns of a matrix with some queries
+
+    The result is the union (or the intersection, if `intersect`) of the
+    selections of all queries, in the same order as `columns`, plus the
+    `always_include` columns. IDs that are not in `columns` are ignored,
+    like `metasplit --ignore_missing` does.
+    """
+    selections = [
+        set(Query.parse(query, metadata_path, clinical_path).resolve())
+        for query in queries
+    ]
+    if not selections:
+        selected = set()
+    elif intersect:
+        selected = set.intersection(*selections)
+    else:
+        selected = set.union(*selections)
+    selected.update(always_include or [])
+
+    missing = selected.difference(columns)
+    if missing:
+        log.debug(f"Ignoring {len(missing)} selected IDs that are not in the matrix")
+
+    return [x for x in columns if x in selected]
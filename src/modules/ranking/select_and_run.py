@@ -1,5 +1,6 @@
 from pathlib import Path
 import json
+import sys
 from subprocess import run
 from functools import partial
 import os
@@ -8,64 +9,47 @@ import multiprocessing as mp
 
 from gene_ranker.methods import RANKING_METHODS
 
-
-def replace(string, pattern, replacement):
-    string = str(string)
-    return string.replace(str(pattern), str(replacement))
-
-
-def run_wrapper(
-    keyvalue, input_matrix_path, input_metadata_path, output_dir, delimiter, method
-):
-    key, value = keyvalue
-    set_meta = partial(
-        replace,
-        pattern="<meta>",
-        replacement=input_metadata_path.expanduser().absolute(),
-    )
+# The shared readers live in the parent folder
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from enrichment import enrich_all, load_coding_genes, load_genesets, read_ranking
+from gene_universe import read_universe
+from matrix_io import read_expression, write_matrix
+from metaquery import select_columns
+
+# The expression matrix, read once by `main` and shared with the workers
+MATRIX = None
+
+
+def resolve_queries(
+    queries: dict, columns: list[str], input_metadata_path, clinical_path=None
+) -> dict:
+    """Find the case and control columns of each query, in the matrix columns"""
+    selections = {}
+    for key, value in queries.items():
+        selections[key] = {
+            part: select_columns(
+                value[part],
+                columns,
+                metadata_path=input_metadata_path,
+                always_include=["sample"],
+                clinical_path=clinical_path,
+                # With "and", samples must match all the queries, not just one
+                intersect=value.get("and", False),
+            )
+            for part in ("case", "control")
+        }
+    return selections
+
+
+def run_wrapper(keyvalue, output_dir, method, keep=False):
+    key, selection = keyvalue
     print(f"Processing {key}.")
 
-    # Make the "case" file
-    print(f"Making input file {key}_case")
-    args = [
-        "metasplit",
-    ]
-    args.extend([set_meta(x) for x in value["case"]])
-    args.extend(
-        [
-            input_matrix_path,
-            output_dir / f"{key}_case",
-            "--ignore_missing",
-            "--input_delimiter",
-            delimiter,
-            "--always_include",
-            "sample",
-        ]
-    )
-    args = [str(x) for x in args]
-    print(f"Executing {' '.join(args)}")
-    run(args, check=True)
-
-    # Make the "control" file
-    print(f"Making input file {key}_control")
-    args = [
-        "metasplit",
-    ]
-    args.extend([set_meta(x) for x in value["control"]])
-    args.extend(
-        [
-            input_matrix_path,
-            output_dir / f"{key}_control",
-            "--ignore_missing",
-            "--input_delimiter",
-            delimiter,
-            "--always_include",
-            "sample",
-        ]
-    )
-    args = [str(x) for x in args]
-    print(f"Executing {' '.join(args)}")
-    run(args, check=True)
+    # Make the "case" and "control" files
+    for part in ("case", "control"):
+        print(f"Making input file {key}_{part}")
+        write_matrix(MATRIX[selection[part]], output_dir / f"{key}_{part}")
 
     # Now we can run run_deseq.R
     dea_args = [
@@ -86,27 +70,45 @@ def run_wrapper(
     os.remove(output_dir / f"{key}_case")
     os.remove(output_dir / f"{key}_control")
 
+    # Send the ranking back, to be enriched
+    if keep:
+        return f"{key}_deseq", read_ranking(output_dir / f"{key}_deseq.csv")
+
 
 def main(
     queries=dict,
     input_matrix_path=Path,
     input_metadata_path=Path,
     output_dir=Path,
-    delimiter=",",
+    delimiter=None,
     cpus=None,
     method="norm_fold_change",
+    clinical_path=None,
+    enrichment=None,
+    universe_path=None,
 ):
+    global MATRIX
+    MATRIX = read_expression(input_matrix_path, id_cols=["sample"], delimiter=delimiter)
+    if universe_path is not None:
+        # The rankings come out keyed and ordered by the universe
+        MATRIX = read_universe(universe_path).align(MATRIX, "sample")
+    # The workers only get the names of the columns to write out
+    selections = resolve_queries(
+        queries, list(MATRIX.columns), input_metadata_path, clinical_path
+    )
+
     run = partial(
-        run_wrapper,
-        input_matrix_path=input_matrix_path,
-        input_metadata_path=input_metadata_path,
-        output_dir=output_dir,
-        delimiter=delimiter,
-        method=method,
+        run_wrapper, output_dir=output_dir, method=method, keep=enrichment is not None
     )
     print("Spawning pool of workers...")
-    with mp.Pool(cpus or mp.cpu_count()) as pool:
-        pool.map(run, queries.items())
+    # The workers must be forked (not spawned), so that they all see the
+    # same matrix without having to read (or be sent) it again
+    with mp.get_context("fork").Pool(cpus or mp.cpu_count()) as pool:
+        rankings = pool.map(run, selections.items())
+
+    if enrichment is not None:
+        print("Running enrichments...")
+        enrich_all(dict(rankings), **enrichment)
 
 
 if __name__ == "__main__":
@@ -118,7 +120,9 @@ if __name__ == "__main__":
         "queries_file", type=Path, help="JSON file with the queries to launch"
     )
     parser.add_argument(
-        "input_matrix", type=Path, help="Input (big) expression matrix to subset"
+        "input_matrix",
+        type=Path,
+        help="Input (big) expression matrix to subset. Can be gzipped.",
     )
     parser.add_argument(
         "input_metadata", type=Path, help="Input metadata matrix to use to subset"
@@ -126,7 +130,10 @@ if __name__ == "__main__":
     parser.add_argument(
         "output_dir", type=Path, help="Output directory to save files to"
     )
-    parser.add_argument("--delimiter", default=",", help="Delimiter for the input")
+    parser.add_argument(
+        "--delimiter",
+        help="Delimiter for the input. If unspecified, it is guessed from the extension.",
+    )
     parser.add_argument(
         "--cpus",
         type=int,
@@ -139,12 +146,64 @@ if __name__ == "__main__":
         choices=RANKING_METHODS.keys(),
         default="norm_fold_change",
     )
+    parser.add_argument(
+        "--genesets",
+        type=Path,
+        help="JSON file with the genesets tree. If given, the rankings are also enriched.",
+    )
+    parser.add_argument(
+        "--enrichments-dir", type=Path, help="Save the (signed) enrichments here"
+    )
+    parser.add_argument(
+        "--absolute-enrichments-dir",
+        type=Path,
+        help="Save the enrichments on the absolute values of the rankings here",
+    )
+    parser.add_argument(
+        "--ensg-data",
+        type=Path,
+        help="A .csv with the 'ensembl_gene_id' and 'gene_biotype' columns, to enrich only protein coding genes",
+    )
+    parser.add_argument(
+        "--unweighted", action="store_true", help="Run the enrichment in an unweighted manner"
+    )
+    parser.add_argument(
+        "--permutations", type=int, default=1000, help="Number of random sets for the enrichment p-values"
+    )
+    parser.add_argument(
+        "--universe",
+        type=Path,
+        help="Gene universe (.arrow, see gene_universe.py) to key and order the genes by",
+    )
+    parser.add_argument(
+        "--null-cache",
+        type=Path,
+        help="Keep the random sets and null distributions of the enrichments in this folder, and reuse them",
+    )
+    parser.add_argument(
+        "--clinical",
+        type=Path,
+        help="Clinical metadata index (.arrow) for the <clinical> queries",
+    )
 
     args = parser.parse_args()
 
     with args.queries_file.open("r") as stream:
         queries = json.load(stream)
 
+    enrichment = None
+    if args.genesets:
+        enrichment = {
+            "genesets": load_genesets(args.genesets),
+            "coding": load_coding_genes(args.ensg_data) if args.ensg_data else None,
+            "output_dir": args.enrichments_dir,
+            "absolute_output_dir": args.absolute_enrichments_dir,
+            "permutations": args.permutations,
+            "unweighted": args.unweighted,
+            "cache_dir": args.null_cache,
+            "universe": read_universe(args.universe) if args.universe else None,
+        }
+
     main(
         queries=queries,
         input_matrix_path=args.input_matrix,
@@ -153,4 +212,7 @@ if __name__ == "__main__":
         delimiter=args.delimiter,
         cpus=args.cpus,
         method=args.method,
+        clinical_path=args.clinical,
+        enrichment=enrichment,
+        universe_path=args.universe,
     )
@@ -1,17 +1,37 @@
 """Preprocess the results from a pipeline and extract information from them
 
 This takes the .tar.gz file(s) made by running the `heatmaps` and `geo_heatmap`
-pipelines and extracts useful information from them.
+pipelines and extracts useful information from them. The files are read
+straight from the archive, without extracting it.
+
+Given many archives (one per ranking method), they are processed in parallel,
+and with `--dataset` all their rankings are saved together in long format, as
+a Parquet dataset partitioned by method and source (TCGA or GEO), e.g.
+
+    <dataset>/method=deseq_shrinkage/source=TCGA/part-0.parquet
+
+so that the analyses that compare methods can load just the slices they need.
 """
 
+import json
 import logging
+import multiprocessing as mp
 import os
 import re
-from functools import reduce
+import sys
+import tarfile
 from pathlib import Path
-from typing import Callable
+from typing import Callable, Optional
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# The shared readers live in the modules folder
+sys.path.insert(0, str(Path(__file__).parent / "modules"))
+
+from geneset_store import write_store
+from matrix_io import delimiter_of, join_frames, memory_footprint, read_expression
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
@@ -34,13 +54,22 @@ def negate(fn: Callable):
 strip_flags = negate(find_re(".*flag.*"))
 
 REQUIRED_FILES = {
-    "data/deas": {"action": "merge", "filters": [strip_flags], "id_col": "sample"},
+    "data/deas": {
+        "action": "merge",
+        "filters": [strip_flags],
+        "id_col": "sample",
+        "source": "TCGA",
+    },
     "data/geo": {
         "action": "merge",
         "filters": [strip_flags, find_re(r".*\.dea\.csv")],
         "id_col": "gene_id",
+        "source": "GEO",
     },
 }
+GENESETS_MEMBER = "data/genesets.json"
+# The archives made by `run_all.makefile` are named <prefix><method>.tar.gz
+ARCHIVE_PREFIX = "packaged_output_"
 
 
 def remove_suffixes(path: Path):
@@ -52,38 +81,87 @@ def remove_suffixes(path: Path):
     return path.name.split(".")[0]
 
 
-def merge_deas(files: list[Path], merge_col: str = "sample") -> pd.DataFrame:
-    data = {}
-    for file in files:
-        log.info(f"Reading in {file}...")
-        data[remove_suffixes(Path(file))] = pd.read_csv(file)
+def member_name(name: str) -> str:
+    """Get the name of a tarball member relative to the root of the archive"""
+    return name[2:] if name.startswith("./") else name
+
+
+def required_key(name: str) -> Optional[str]:
+    """Find which of the REQUIRED_FILES a tarball member is part of, if any
+
+    The member must be inside the required folder, and pass all its filters.
+    """
+    for key, value in REQUIRED_FILES.items():
+        if not name.startswith(key + "/"):
+            continue
+        if all(fn(name) for fn in value["filters"]):
+            return key
+    return None
+
+
+def merge_deas(frames: list[pd.DataFrame], merge_col: str = "sample") -> pd.DataFrame:
     # The files have all the same structure: a col with 'sample' and one with
-    # 'ranking'. We must rename the 'ranking' col with the name of the file
-    # and then do a many-way merge
+    # 'ranking' (already renamed with the name of the file), so we just need
+    # a many-way merge
     log.info("Merging data...")
-    renamed = {k: v.rename(columns={"ranking": k}) for k, v in data.items()}
-    merged = reduce(lambda x, y: pd.merge(
-        x, y, on=merge_col), renamed.values())
+    merged = join_frames(frames, on=merge_col)
+    log.info(f"Merged frame takes {memory_footprint(merged) / 2**20:.1f} MiB in memory")
 
     return merged
 
 
-def main(args):
-    log.info(f"Reading in {args.input_dir}")
+def read_archive(
+    tarball: Path, genesets: Optional[Path] = None, store: Optional[Path] = None
+) -> dict:
+    """Read the files to merge straight out of a (possibly compressed) tarball
 
-    if args.slug == "auto":
-        slug = remove_suffixes(args.input_tarball)
-    else:
-        slug = args.slug
-    log.info(f"Slug is '{slug}'.")
+    The archive is streamed, and only the members that we need are parsed,
+    so nothing is ever extracted to the disk.
 
-    log.info("Looking for files...")
-    files = args.input_dir.iterdir()
-    names = [x.name for x in files]
+    Returns a dictionary of REQUIRED_FILES key -> list of frames to merge.
+    If `genesets` is given, the genesets of the archive are saved there.
+    If `store` is given, they are also saved there as a geneset store (see
+    `geneset_store.py`), so single genesets can be fetched without `jq`.
+    """
+    found = set()
+    frames = {key: [] for key in REQUIRED_FILES}
+    with tarfile.open(tarball, "r|*") as archive:
+        for member in archive:
+            name = member_name(member.name)
+            found.update(x for x in REQUIRED_FILES if name.startswith(x + "/"))
+            if not member.isfile():
+                continue
+
+            if name == GENESETS_MEMBER and (genesets or store) is not None:
+                content = archive.extractfile(member).read()
+                if genesets is not None:
+                    log.info(f"Saving {name} to {genesets}...")
+                    genesets.write_bytes(content)
+                if store is not None:
+                    log.info(f"Saving {name} as a geneset store to {store}...")
+                    with store.open("wb") as stream:
+                        write_store(json.loads(content), stream)
+                continue
+
+            key = required_key(name)
+            if key is None:
+                continue
+            log.info(f"Reading in {name}...")
+            id_col = REQUIRED_FILES[key].get("id_col", "sample")
+            data = read_expression(
+                archive.extractfile(member),
+                id_cols=[id_col],
+                delimiter=delimiter_of(Path(name)),
+                # The rankings are written out again, so keep them as they are
+                float_type=None,
+            )
+            frames[key].append(
+                data.rename(columns={"ranking": remove_suffixes(Path(name))})
+            )
 
     all_found = True
     for internal_path in REQUIRED_FILES.keys():
-        if internal_path in names:
+        if internal_path in found:
             log.info(f"Found {internal_path}.")
         else:
             log.error(f"{internal_path} does not exist!")
@@ -91,34 +169,134 @@ def main(args):
     if not all_found:
         raise ValueError("Could not find some required files in archive.")
 
+    return frames
+
+
+def method_of(tarball: Path) -> str:
+    """Get the ranking method that made an archive, from its name"""
+    slug = remove_suffixes(tarball)
+    return slug[len(ARCHIVE_PREFIX):] if slug.startswith(ARCHIVE_PREFIX) else slug
+
+
+def to_long(frames: list[pd.DataFrame], id_col: str) -> pd.DataFrame:
+    """Stack the rankings of many files, one row per gene and file
+
+    Unlike the merged tables, this keeps all the genes of all the files.
+    """
+    parts = []
+    for frame in frames:
+        name = next(x for x in frame.columns if x != id_col)
+        parts.append(
+            pd.DataFrame(
+                {
+                    "gene_id": frame[id_col].astype(str),
+                    "query": name,
+                    "ranking": frame[name],
+                }
+            )
+        )
+    data = pd.concat(parts, ignore_index=True)
+    data["query"] = data["query"].astype("category")
+    return data
+
+
+def write_partitions(frames: dict, dataset: Path, method: str):
+    """Save the rankings of one archive to its partitions of the dataset
+
+    The old partitions of the same method are replaced, the others are left
+    alone, so archives can be written in parallel (or one at a time).
+    """
+    for key, value in REQUIRED_FILES.items():
+        data = to_long(frames[key], value.get("id_col", "sample"))
+        data["method"] = method
+        data["source"] = value["source"]
+        log.info(f"Saving {len(data)} {value['source']} rankings of {method} to {dataset}...")
+        ds.write_dataset(
+            pa.Table.from_pandas(data, preserve_index=False),
+            dataset,
+            format="parquet",
+            partitioning=["method", "source"],
+            partitioning_flavor="hive",
+            basename_template="part-{i}.parquet",
+            existing_data_behavior="delete_matching",
+        )
+
+
+def process_archive(
+    tarball: Path,
+    output_dir: Optional[Path] = None,
+    dataset: Optional[Path] = None,
+    slug: str = "auto",
+    genesets: Optional[Path] = None,
+    store: Optional[Path] = None,
+):
+    log.info(f"Reading in {tarball}")
+
+    if slug == "auto":
+        slug = remove_suffixes(tarball)
+    log.info(f"Slug is '{slug}'.")
+
+    frames = read_archive(tarball, genesets, store)
+
+    if dataset is not None:
+        write_partitions(frames, dataset, method_of(tarball))
+
+    if output_dir is None:
+        return
+
     for key, value in REQUIRED_FILES.items():
         if value["action"] == "merge":
             log.info(f"Merging contents of {key}")
-            files_to_merge = [
-                x for x in names if x.startswith(key) and x != key]
-            for fn in value["filters"]:
-                files_to_merge = filter(fn, files_to_merge)
-            merged = merge_deas(files_to_merge, value.get("id_col", "sample"))
+            merged = merge_deas(frames[key], value.get("id_col", "sample"))
 
-            target = args.output_dir / \
+            target = output_dir / \
                 f"{slug}_{remove_suffixes(Path(key))}.csv"
             log.info(f"Saving to {target}...")
 
             merged.to_csv(target, index=False)
 
 
+def main(args):
+    if len(args.input_tarball) == 1:
+        process_archive(
+            args.input_tarball[0],
+            args.output_dir,
+            args.dataset,
+            args.slug,
+            args.genesets,
+            args.genesets_store,
+        )
+        return
+
+    if args.slug != "auto" or (args.genesets or args.genesets_store) is not None:
+        raise ValueError(
+            "Cannot use --slug, --genesets or --genesets-store with more than one archive"
+        )
+
+    # Each archive is decompressed and parsed by its own process
+    cpus = min(args.cpus or mp.cpu_count(), len(args.input_tarball))
+    with mp.Pool(cpus) as pool:
+        pool.starmap(
+            process_archive,
+            [(x, args.output_dir, args.dataset) for x in args.input_tarball],
+        )
+
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
-        "input_dir",
+        "input_tarball",
         type=Path,
-        help="Path to the directory with all DEAs (usually data/)",
+        nargs="+",
+        help="Path to the packaged output(s) of a pipeline (.tar or .tar.gz)",
     )
     parser.add_argument(
-        "output_dir", type=Path, help="Path to a dir to save the outputs in"
+        "--output-dir",
+        type=Path,
+        help="Path to a dir to save the merged outputs in. If unspecified, nothing is merged.",
     )
     parser.add_argument(
         "--slug",
@@ -126,9 +304,30 @@ if __name__ == "__main__":
         default="auto",
         help="Override the slug give to the output files",
     )
+    parser.add_argument(
+        "--dataset",
+        type=Path,
+        help="Also save all the rankings to this (partitioned) Parquet dataset",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        help="Number of archives to process at once. If unspecified, uses all available cores.",
+    )
+    parser.add_argument(
+        "--genesets",
+        type=Path,
+        help="Also save the genesets used by the pipeline (the data/genesets.json in the archive) here",
+    )
+    parser.add_argument(
+        "--genesets-store",
+        type=Path,
+        help="Also save the genesets used by the pipeline here, as a geneset store (see modules/geneset_store.py)",
+    )
 
     args = parser.parse_args()
 
-    os.makedirs(args.output_dir, exist_ok=True)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
 
     main(args)
@@ -8,22 +8,9 @@
 #?
 #? This makes the analysis very quick, for testing purposes.
 
-echo "Extracting sources"
-gunzip -cv ./data/in/expression_matrix.tsv.gz > ./data/expression_matrix.tsv
-gunzip -cv ./data/in/expression_matrix_metadata.tsv.gz > ./data/expression_matrix_metadata.tsv
-
-echo "Reformatting as .csv"
-xsv fmt -d '\t' ./data/expression_matrix_metadata.tsv > ./data/expression_matrix_metadata.csv
-xsv fmt -d '\t' ./data/expression_matrix.tsv > ./data/expression_matrix.csv
-
+# metasample reads and writes the compressed .tsv files directly
 echo "Running metasample"
 ./src/metasample.py --metavars _primary_site --always-include sample \
-    ./data/expression_matrix.csv ./data/test_expression_matrix.csv \
-    ./data/expression_matrix_metadata.csv sample \
+    ./data/in/expression_matrix.tsv.gz ./data/in/test_expression_matrix.tsv.gz \
+    ./data/in/expression_matrix_metadata.tsv.gz sample \
     "25%" 5000
-
-echo "Reformatting as .tsv"
-xsv fmt -t '\t' ./data/test_expression_matrix.csv > ./data/test_expression_matrix.tsv
-
-echo "Compressing and saving as input file"
-gzip -cv ./data/test_expression_matrix.tsv > ./data/in/test_expression_matrix.tsv.gz